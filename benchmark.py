@@ -0,0 +1,838 @@
+"""
+Benchmarks for the Relation Network components, running on synthetic tensors
+"""
+from __future__ import print_function
+
+import argparse
+import ctypes
+import json
+import os
+import platform
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from model import RN
+from utils import activation_bytes, BATCH_SIZE_PROBE_VERSION
+
+
+def load_hyp(config, model, **overrides):
+    with open(config) as config_file:
+        hyp = json.load(config_file)['hyperparams'][model]
+    hyp.update(overrides)
+    return hyp
+
+
+def build_model(hyp, qdict_size=80, adict_size=28, seed=42):
+    torch.manual_seed(seed)
+    args = argparse.Namespace(qdict_size=qdict_size, adict_size=adict_size)
+    return RN(args, hyp)
+
+
+def synthetic_batch(hyp, batch_size, n_objects=12, qst_len=20, qdict_size=80, adict_size=28):
+    if hyp['state_description']:
+        img = torch.randn(batch_size, n_objects, hyp['rl_in_size'] // 2)
+    else:
+        img = torch.randn(batch_size, 3, 128, 128)
+    qst = torch.randint(1, qdict_size + 1, (batch_size, qst_len), dtype=torch.long)
+    label = torch.randint(0, adict_size, (batch_size,), dtype=torch.long)
+    return img, qst, label
+
+
+def allocated_bytes(fn):
+    """
+    Total bytes allocated on CPU while running fn (freed memory is not subtracted)
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0)
+
+
+def peak_bytes(fn):
+    """
+    Peak of the CPU memory allocated while running fn, relative to the memory in use before it.
+    Allocations and frees are replayed in the order the profiler recorded them.
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    in_use = peak = 0
+    for e in sorted(prof.events(), key=lambda e: e.time_range.start):
+        in_use += e.self_cpu_memory_usage
+        peak = max(peak, in_use)
+    return peak
+
+
+def time_step(model, img, qst, label, backward=True, repeats=3):
+    """
+    Returns the best wall time (seconds) of a forward (and optionally backward) pass.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        model.zero_grad()
+        start = time.perf_counter()
+        loss = F.nll_loss(model(img, qst), label)
+        if backward:
+            loss.backward()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_factorized(args):
+    """
+    Dense vs factorized first g layer: checks that the two paths agree,
+    then measures time and activation memory of a training step.
+    """
+    for model_name in args.models:
+        hyp = load_hyp(args.config, model_name, factorized_g=False)
+        dense = build_model(hyp)
+        factorized = build_model(load_hyp(args.config, model_name, factorized_g=True))
+        factorized.load_state_dict(dense.state_dict())
+        dense.train(False)
+        factorized.train(False)
+
+        img, qst, label = synthetic_batch(hyp, args.batch_size)
+        with torch.no_grad():
+            diff = (dense(img, qst) - factorized(img, qst)).abs().max().item()
+        assert diff < 1e-4, 'factorized g layer differs from the dense one ({})'.format(diff)
+
+        for name, model in (('dense', dense), ('factorized', factorized)):
+            model.train()
+            _, act = activation_bytes(lambda: model(img, qst))
+            t = time_step(model, img, qst, label, repeats=args.repeats)
+            print('{} [{}] bs {}: {:.3f} s/step; activations {:.1f} MB'.format(
+                model_name, name, args.batch_size, t, act / 2**20))
+        print('{}: max abs difference between outputs {:.2e}'.format(model_name, diff))
+
+
+def bench_injection(args):
+    """
+    Question injection by concatenating a copy of the question to every pair vs by broadcasting
+    its projection, and a coordinate tensor rebuilt at every step vs expanded from a buffer.
+    Reports time and bytes allocated by a training step.
+    """
+    for model_name in args.models:
+        for broadcast in (False, True):
+            hyp = load_hyp(args.config, model_name, broadcast_injection=broadcast)
+            model = build_model(hyp)
+            if not broadcast:
+                # old behaviour: a (B x 2 x 8*8) coordinate tensor built with repeat() at every forward
+                model.objects = legacy_objects(model)
+            img, qst, label = synthetic_batch(hyp, args.batch_size)
+
+            def step():
+                model.zero_grad()
+                F.nll_loss(model(img, qst), label).backward()
+
+            allocated = allocated_bytes(step)
+            elapsed = time_step(model, img, qst, label, repeats=args.repeats)
+            print('{} [{}]: {:.3f} s/step, {:.1f} MB allocated/step'.format(
+                model_name, 'broadcast' if broadcast else 'concatenated', elapsed, allocated / 2**20))
+
+
+def legacy_objects(model):
+    def objects(img):
+        if model.state_desc:
+            return img
+        x = model.conv(img)
+        b, k, d, _ = x.size()
+        coords = model.build_coord_tensor(d).view(1, 2, d, d).repeat(b, 1, 1, 1)
+        x = torch.cat([x.view(b, k, d*d), coords.view(b, 2, d*d)], 1)
+        return x.permute(0, 2, 1)
+    return objects
+
+
+def bench_tiled(args):
+    """
+    Untiled vs tiled g evaluation (tiles are recomputed in backward)
+    """
+    variants = [('untiled', {}),
+                ('tiled', dict(g_tile_size=args.tile_size))]
+    for model_name in args.models:
+        reference = None
+        for name, overrides in variants:
+            hyp = load_hyp(args.config, model_name, **overrides)
+            model = build_model(hyp)
+            if reference is None:
+                reference = model.state_dict()
+            model.load_state_dict(reference)
+
+            img, qst, label = synthetic_batch(hyp, args.batch_size)
+            _, act = activation_bytes(lambda: model(img, qst))
+            t = time_step(model, img, qst, label, repeats=args.repeats)
+            print('{} [{}] bs {}: {:.3f} s/step; activations {:.1f} MB'.format(
+                model_name, name, args.batch_size, t, act / 2**20))
+
+
+def bench_cached(args):
+    """
+    Per-question inference vs inference sharing image_state() among the questions of every image
+    """
+    for model_name in args.models:
+        hyp = load_hyp(args.config, model_name)
+        model = build_model(hyp)
+        model.eval()
+
+        n_images = max(1, args.batch_size // args.questions_per_image)
+        img, qst, _ = synthetic_batch(hyp, n_images)
+        img_index = torch.arange(n_images).repeat_interleave(args.questions_per_image)
+        qst = qst[img_index % n_images].clone()
+        qst[:, -1] = torch.randint(1, 81, (len(img_index),))
+
+        def per_question():
+            return model(img.index_select(0, img_index), qst)
+
+        def cached():
+            return model.answer(model.image_state(img), qst, img_index)
+
+        with torch.no_grad():
+            diff = (per_question() - cached()).abs().max().item()
+            assert diff < 1e-4, 'cached image state gives different answers ({})'.format(diff)
+            for name, fn in (('per-question', per_question), ('cached', cached)):
+                best = float('inf')
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    fn()
+                    best = min(best, time.perf_counter() - start)
+                print('{} [{}] {} questions on {} images: {:.3f} s/batch'.format(
+                    model_name, name, len(img_index), n_images, best))
+
+
+def bench_packed(args):
+    """
+    Padded vs packed evaluation of the pairs for state descriptions. Scenes have a random number
+    of objects (3 to 10, as in CLEVR) padded to 12.
+    The packed result on every scene is checked against the padded model run on that scene without padding.
+    """
+    for model_name in args.models:
+        padded = build_model(load_hyp(args.config, model_name))
+        packed = build_model(load_hyp(args.config, model_name, packed_pairs=True))
+        packed.load_state_dict(padded.state_dict())
+        assert padded.state_desc, 'packed pairs are meant for state descriptions models'
+
+        img, qst, label = synthetic_batch(load_hyp(args.config, model_name), args.batch_size)
+        object_counts = torch.randint(3, 11, (args.batch_size,))
+        img[torch.arange(12).unsqueeze(0) >= object_counts.unsqueeze(1)] = 0
+
+        padded.eval()
+        packed.eval()
+        with torch.no_grad():
+            out = packed(img, qst, object_counts)
+            for i in range(min(args.batch_size, 8)):
+                n = object_counts[i].item()
+                diff = (out[i] - padded(img[i:i+1, :n], qst[i:i+1])[0]).abs().max().item()
+                assert diff < 1e-4, 'packed pairs differ from the unpadded scene ({})'.format(diff)
+
+        padded_pairs = args.batch_size * 12**2
+        real_pairs = (object_counts**2).sum().item()
+        for name, model, counts in (('padded', padded, None), ('packed', packed, object_counts)):
+            model.train()
+            best = float('inf')
+            for _ in range(args.repeats):
+                model.zero_grad()
+                start = time.perf_counter()
+                F.nll_loss(model(img, qst, counts), label).backward()
+                best = min(best, time.perf_counter() - start)
+            print('{} [{}] bs {}: {:.3f} s/step; {} pairs'.format(
+                model_name, name, args.batch_size, best, real_pairs if counts is not None else padded_pairs))
+
+
+def bench_questions(args):
+    """
+    Padding fraction and LSTM time (forward and backward) of question batches: padded vs packed
+    sequences, with random batches vs batches bucketed by length.
+    Question lengths come from the CLEVR training set if --clevr-dir is given, otherwise they are random.
+    """
+    from clevr_dataset_connector import LengthBucketBatchSampler, ClevrQuestionStore
+    import utils
+
+    if args.clevr_dir:
+        dictionaries = utils.build_dictionaries(args.clevr_dir)
+        lengths = ClevrQuestionStore(args.clevr_dir, True, dictionaries).lengths()
+    else:
+        lengths = torch.randint(4, 44, (args.batch_size * args.batches * 4,))
+
+    hyp = load_hyp(args.config, args.models[0])
+    model = build_model(hyp).text
+    samplers = [('random', list(torch.randperm(len(lengths)).split(args.batch_size))),
+                ('bucketed', list(LengthBucketBatchSampler(lengths, args.batch_size)))]
+    for sampler_name, batches in samplers:
+        batches = [torch.as_tensor(b) for b in batches[:args.batches]]
+        batch_lengths = [lengths[b] for b in batches]
+        padding = 1 - sum(l.sum().item() for l in batch_lengths) / float(sum(len(l) * l.max().item() for l in batch_lengths))
+
+        for packed in (False, True):
+            start = time.perf_counter()
+            for l in batch_lengths:
+                qst = torch.randint(1, 81, (len(l), l.max().item()), dtype=torch.long)
+                model.zero_grad()
+                model(qst, l if packed else None).sum().backward()
+            elapsed = time.perf_counter() - start
+            print('{} batches, {} LSTM: padding {:.1%}; {:.1f} ms/batch'.format(
+                sampler_name, 'packed' if packed else 'padded', padding, 1000 * elapsed / len(batch_lengths)))
+
+
+def bench_question_cache(args):
+    """
+    Question embedding time with and without the embedding cache, on batches drawn from
+    a pool of --distinct-questions questions (CLEVR questions come from templates and repeat).
+    """
+    for model_name in args.models:
+        hyp = load_hyp(args.config, model_name)
+        model = build_model(hyp).text
+        model.eval()
+
+        pool = torch.randint(1, 81, (args.distinct_questions, 20), dtype=torch.long)
+        batches = [pool[torch.randint(0, len(pool), (args.batch_size,))] for _ in range(args.batches)]
+        with torch.no_grad():
+            for cache_size in (0, args.cache_size):
+                model.enable_cache(cache_size)
+                start = time.perf_counter()
+                for qst in batches:
+                    model(qst)
+                elapsed = time.perf_counter() - start
+                hits = ', {:.1%} hits'.format(model.cache.hit_rate()) if model.cache is not None else ''
+                print('{} [cache size {}]: {:.1f} ms/batch{}'.format(
+                    model_name, cache_size, 1000 * elapsed / len(batches), hits))
+
+
+SUITE_COMPONENTS = ['conv', 'text', 'rl', 'rn']
+SUITE_FORMAT_VERSION = 1
+
+
+def suite_inputs(component, hyp, model, batch_size, n_objects):
+    """
+    Module to benchmark and its synthetic inputs. Returns None if the component does not
+    apply to the configuration (no convolutions for state descriptions).
+    """
+    img, qst, label = synthetic_batch(hyp, batch_size, n_objects=n_objects)
+    if component == 'conv':
+        return None if hyp['state_description'] else (model.conv, (img,))
+    if component == 'text':
+        return model.text, (qst,)
+    if component == 'rl':
+        objects = torch.randn(batch_size, n_objects, hyp['rl_in_size'] // 2)
+        return model.rl, (objects, torch.randn(batch_size, hyp['lstm_hidden']))
+    return model, (img, qst)
+
+
+def bench_component(module, inputs, repeats):
+    """
+    Best forward and backward times (seconds) and peak memory (bytes) of a training step of module.
+    """
+    def forward():
+        return module(*inputs)
+
+    def step():
+        module.zero_grad()
+        forward().float().sum().backward()
+
+    step()  # warm up
+    forward_time = backward_time = float('inf')
+    for _ in range(repeats):
+        module.zero_grad()
+        start = time.perf_counter()
+        out = forward()
+        middle = time.perf_counter()
+        out.float().sum().backward()
+        end = time.perf_counter()
+        forward_time = min(forward_time, middle - start)
+        backward_time = min(backward_time, end - middle)
+    return forward_time, backward_time, peak_bytes(step)
+
+
+def bench_suite(args):
+    """
+    Forward and backward time, throughput and peak memory of every component of the network,
+    for every configuration, batch size and number of objects. Results are written to --output
+    and, if --baseline is given, compared against it.
+    """
+    results = []
+    for model_name in args.models:
+        hyp = load_hyp(args.config, model_name)
+        model = build_model(hyp)
+        model.train()
+        for component in args.components:
+            for batch_size in args.batch_sizes:
+                # with images, the objects are the 8x8 cells of the convolutional output
+                object_counts = args.object_counts if hyp['state_description'] or component == 'rl' else [64]
+                if component in ('conv', 'text'):
+                    object_counts = object_counts[:1]
+                for n_objects in object_counts:
+                    bench = suite_inputs(component, hyp, model, batch_size, n_objects)
+                    if bench is None:
+                        continue
+                    forward_time, backward_time, peak = bench_component(bench[0], bench[1], args.repeats)
+                    record = dict(component=component, model=model_name, batch_size=batch_size,
+                                  n_objects=n_objects if component not in ('conv', 'text') else None,
+                                  forward_ms=1000 * forward_time, backward_ms=1000 * backward_time,
+                                  samples_per_sec=batch_size / (forward_time + backward_time), peak_mb=peak / 2**20)
+                    results.append(record)
+                    print('{model} {component:<4} bs {batch_size:<4} objects {n_objects!s:<4}: forward {forward_ms:8.2f} ms, '
+                          'backward {backward_ms:8.2f} ms, {samples_per_sec:9.1f} samples/s, peak {peak_mb:8.1f} MB'.format(**record))
+
+    output = dict(version=SUITE_FORMAT_VERSION, torch=torch.__version__, threads=torch.get_num_threads(),
+                  machine=platform.machine(), processor=platform.processor(), time=time.time(), results=results)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    print('==> results written to {}'.format(args.output))
+
+    if args.baseline:
+        compare_results(args.output, args.baseline, args.tolerance)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        results = json.load(f)
+    assert results['version'] == SUITE_FORMAT_VERSION, 'Unsupported results version in {}'.format(filename)
+    return results
+
+
+def compare_results(results_file, baseline_file, tolerance):
+    """
+    Compares two suite results files; a measure is a regression if it got worse than the
+    baseline by more than tolerance (relative). Exits with status 1 if there are regressions.
+    """
+    def key(r):
+        return r['component'], r['model'], r['batch_size'], r['n_objects']
+
+    results, baseline = load_results(results_file), load_results(baseline_file)
+    if (results['torch'], results['threads'], results['machine']) != (baseline['torch'], baseline['threads'], baseline['machine']):
+        print('==> warning: results come from a different environment than the baseline')
+    baseline = {key(r): r for r in baseline['results']}
+
+    regressions = 0
+    for r in results['results']:
+        b = baseline.get(key(r))
+        if b is None:
+            continue
+        time_ratio = (r['forward_ms'] + r['backward_ms']) / (b['forward_ms'] + b['backward_ms'])
+        memory_ratio = r['peak_mb'] / b['peak_mb'] if b['peak_mb'] > 0 else 1.0
+        flags = [name for name, ratio in (('TIME', time_ratio), ('MEMORY', memory_ratio)) if ratio > 1 + tolerance]
+        regressions += bool(flags)
+        print('{} {:<4} bs {:<4} objects {!s:<4}: time x{:.2f}, memory x{:.2f} {}'.format(
+            r['model'], r['component'], r['batch_size'], r['n_objects'], time_ratio, memory_ratio,
+            'REGRESSION ({})'.format(', '.join(flags)) if flags else ''))
+
+    print('==> {} regressions over tolerance {:.0%}'.format(regressions, tolerance))
+    if regressions:
+        sys.exit(1)
+
+
+def bench_compare(args):
+    compare_results(args.results, args.baseline, args.tolerance)
+
+
+def process_memory(pid):
+    """
+    Returns (resident, private) memory in MB of a process; private memory counts the pages
+    the process does not share any more with its parent, e.g. after copy-on-write. Linux only.
+    """
+    memory = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as smaps:
+        for line in smaps:
+            fields = line.split()
+            if fields[0] in ('Rss:', 'Private_Clean:', 'Private_Dirty:'):
+                memory[fields[0]] = int(fields[1]) / 1024.
+    return memory['Rss:'], memory['Private_Clean:'] + memory['Private_Dirty:']
+
+
+def child_pids():
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid)) as stat:
+                # the name of the process, in parenthesis, may contain spaces
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError):
+            continue
+        if ppid == os.getpid():
+            pids.append(int(pid))
+    return sorted(pids)
+
+
+# mallopt parameter of glibc
+M_MMAP_THRESHOLD = -3
+
+
+def fixed_mmap_threshold(worker_id):
+    # glibc raises its mmap threshold when large blocks (as collated batches) are freed, so that later
+    # batches grow the heap of the worker. A fixed threshold keeps this growth out of the measure
+    ctypes.CDLL('libc.so.6').mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+
+
+def bench_worker_memory(args):
+    """
+    Iterates over the CLEVR training set for --epochs epochs with persistent multi-worker DataLoader,
+    as train.py does, and reports resident and private memory of every worker along the way.
+    Private memory staying flat means that workers are not copying the dataset: the check passes if
+    no worker grows by more than --max-growth MB from its first batch to the end.
+    """
+    import utils
+    from train import initialize_dataset
+
+    hyp = load_hyp(args.config, args.models[0])
+    dictionaries = utils.build_dictionaries(args.clevr_dir)
+    clevr_dataset_train, _ = initialize_dataset(args.clevr_dir, dictionaries, hyp['state_description'])
+    collate_fn = utils.collate_samples_state_description if hyp['state_description'] else utils.collate_samples_from_pixels
+    loader = DataLoader(clevr_dataset_train, batch_size=args.batch_size, shuffle=True,
+                        num_workers=args.workers, collate_fn=collate_fn, persistent_workers=True,
+                        worker_init_fn=fixed_mmap_threshold)
+
+    n_batches = min(args.batches, len(loader)) if args.batches > 0 else len(loader)
+    # private memory of every worker at its first measure, and at the last one
+    first, last = {}, {}
+    for epoch in range(1, args.epochs + 1):
+        for batch_idx, _ in enumerate(loader):
+            if batch_idx % args.log_interval == 0 or batch_idx == n_batches - 1:
+                workers = {pid: process_memory(pid) for pid in child_pids()}
+                print('epoch {} batch {}/{}: '.format(epoch, batch_idx + 1, n_batches) + '; '.join(
+                    'worker {} rss {:.0f} MB private {:.0f} MB'.format(i, rss, private)
+                    for i, (rss, private) in enumerate(workers.values())))
+                last = {pid: private for pid, (rss, private) in workers.items()}
+                for pid, private in last.items():
+                    first.setdefault(pid, private)
+            if batch_idx + 1 >= n_batches:
+                break
+
+    growth = max(last[pid] - first[pid] for pid in last) if last else 0.0
+    passed = growth <= args.max_growth
+    print('==> worker private memory grew by up to {:.1f} MB in {} epochs: {}'.format(
+        growth, args.epochs, 'PASS' if passed else 'FAIL (more than {} MB)'.format(args.max_growth)))
+    if not passed:
+        sys.exit(1)
+
+
+def is_out_of_memory(error):
+    """
+    Whether error comes from an allocation failure: CUDA out of memory, the CPU allocator
+    of torch refusing an allocation, or python itself running out of memory.
+    """
+    if isinstance(error, (MemoryError, torch.cuda.OutOfMemoryError)):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+def probe_step(hyp, batch_size, qst_len, cuda, repeats):
+    """
+    Peak memory (bytes) of the first training step of a new model with Adam, including gradients
+    and optimizer state, and best time (seconds) of the following steps.
+    Returns (None, None) if the step runs out of memory.
+    """
+    model = build_model(hyp)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    img, qst, label = synthetic_batch(hyp, batch_size, qst_len=qst_len)
+    if cuda:
+        model.cuda()
+        img, qst, label = img.cuda(), qst.cuda(), label.cuda()
+
+    def step():
+        optimizer.zero_grad()
+        F.nll_loss(model(img, qst), label).backward()
+        optimizer.step()
+        if cuda:
+            torch.cuda.synchronize()
+
+    try:
+        if cuda:
+            torch.cuda.reset_peak_memory_stats()
+            before = torch.cuda.memory_allocated()
+            step()
+            peak = torch.cuda.max_memory_allocated() - before
+        else:
+            peak = peak_bytes(step)
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            step()
+            best = min(best, time.perf_counter() - start)
+    except (RuntimeError, MemoryError) as e:
+        if not is_out_of_memory(e):
+            raise
+        return None, None
+    finally:
+        del model, optimizer
+        if cuda:
+            torch.cuda.empty_cache()
+    return peak, best
+
+
+def bench_batch_size(args):
+    """
+    Largest batch size whose training step fits in --memory-budget, for every configuration:
+    the batch size is doubled until the step does not fit, then bisected. The throughput of all the
+    probed sizes is reported, and results are written to --output, to be used by train.py --batch-size-probe.
+    """
+    cuda = args.cuda and torch.cuda.is_available()
+    budget = args.memory_budget * 2**20
+    results = {}
+    for model_name in args.models:
+        hyp = load_hyp(args.config, model_name)
+        curve = []
+
+        def probe(batch_size):
+            peak, step_time = probe_step(hyp, batch_size, args.question_length, cuda, args.repeats)
+            fits = peak is not None and peak <= budget
+            record = dict(batch_size=batch_size, fits=fits, peak_mb=peak / 2**20 if peak is not None else None,
+                          samples_per_sec=batch_size / step_time if step_time is not None else None)
+            curve.append(record)
+            print('{} bs {:<5}: peak {} MB, {} samples/s{}'.format(
+                model_name, batch_size, '{:.1f}'.format(record['peak_mb']) if peak is not None else 'OOM',
+                '{:.1f}'.format(record['samples_per_sec']) if step_time is not None else '-', '' if fits else ' (does not fit)'))
+            return fits
+
+        # doubling, then bisection between the largest size that fits and the smallest that does not
+        low, high = 0, args.start_batch_size
+        while high <= args.max_batch_size and probe(high):
+            low, high = high, high * 2
+        high = min(high, args.max_batch_size + 1)
+        while high - low > max(1, low // args.resolution):
+            middle = (low + high) // 2
+            if probe(middle):
+                low = middle
+            else:
+                high = middle
+
+        curve.sort(key=lambda r: r['batch_size'])
+        results[model_name] = dict(max_batch_size=low, hyp=hyp, curve=curve)
+        if low == 0:
+            print('==> {}: not even a batch of {} fits in {} MB'.format(model_name, args.start_batch_size, args.memory_budget))
+        else:
+            print('==> {}: largest batch size fitting in {} MB is {}'.format(model_name, args.memory_budget, low))
+
+    output = dict(version=BATCH_SIZE_PROBE_VERSION, memory_budget_mb=args.memory_budget, cuda=cuda,
+                  torch=torch.__version__, threads=torch.get_num_threads(), time=time.time(), models=results)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    print('==> results written to {}'.format(args.output))
+
+
+def bench_epoch_boundary(args):
+    """
+    Time from the start of every epoch to its first training batch, when the batch size grows at
+    every epoch: rebuilding the loaders (and restarting their workers) vs resizing the batch sampler
+    of persistent workers, as train.py does.
+    """
+    import utils
+    from train import initialize_dataset, reload_loaders, resize_loader
+
+    hyp = load_hyp(args.config, args.models[0])
+    dictionaries = utils.build_dictionaries(args.clevr_dir)
+    clevr_dataset_train, clevr_dataset_test = initialize_dataset(args.clevr_dir, dictionaries, hyp['state_description'])
+
+    for mode in ('respawn', 'persistent'):
+        stalls = []
+        loader = None
+        for epoch in range(args.epochs):
+            batch_size = args.batch_size * 2 ** epoch
+            start = time.perf_counter()
+            if mode == 'respawn' or loader is None:
+                loader, _ = reload_loaders(clevr_dataset_train, clevr_dataset_test, batch_size, batch_size,
+                                           hyp['state_description'], num_workers=args.workers)
+            else:
+                resize_loader(loader, batch_size)
+            for batch_idx, _ in enumerate(loader):
+                if batch_idx == 0:
+                    stalls.append(time.perf_counter() - start)
+                if batch_idx + 1 >= args.batches:
+                    break
+        print('{} [{}] workers {}: first batch after {} s (mean over epoch boundaries {:.3f} s)'.format(
+            args.models[0], mode, args.workers, ', '.join('{:.3f}'.format(t) for t in stalls),
+            sum(stalls[1:]) / max(1, len(stalls) - 1)))
+        del loader
+
+
+def ddp_worker(rank, world_size, args, model_name, port, results):
+    """
+    One process of bench_ddp: trains on its share of the global batch and, on rank 0,
+    puts the mean step time into results.
+    """
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    hyp = load_hyp(args.config, model_name)
+    model = build_model(hyp)
+    if hyp['state_description']:
+        # as in train.py, the unused convolutional layers would never receive gradients
+        model.conv.requires_grad_(False)
+    model = torch.nn.parallel.DistributedDataParallel(model)
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=1e-4)
+    torch.manual_seed(rank)
+    img, qst, label = synthetic_batch(hyp, args.batch_size // world_size)
+
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            dist.barrier()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        F.nll_loss(model(img, qst), label).backward()
+        optimizer.step()
+    dist.barrier()
+    if rank == 0:
+        results.put((time.perf_counter() - start) / args.steps)
+    dist.destroy_process_group()
+
+
+def bench_ddp(args):
+    """
+    Training throughput with DistributedDataParallel on gloo, for a growing number of processes
+    on this host. The global batch is split among processes, and so are the cpu cores.
+    """
+    assert args.batch_size % max(args.processes) == 0, 'batch size has to be divisible by every number of processes'
+    ctx = mp.get_context('spawn')
+    print('==> {} cpu cores available'.format(os.cpu_count()))
+    for model_name in args.models:
+        base = None
+        for i, world_size in enumerate(args.processes):
+            results = ctx.SimpleQueue()
+            mp.spawn(ddp_worker, args=(world_size, args, model_name, args.port + i, results), nprocs=world_size)
+            step_time = results.get()
+            samples = args.batch_size / step_time
+            base = base or samples / world_size
+            print('{} bs {} processes {}: {:.3f} s/step, {:.1f} samples/s, speedup {:.2f}, efficiency {:.0f}%'.format(
+                model_name, args.batch_size, world_size, step_time, samples,
+                samples / base, 100. * samples / (base * world_size)))
+
+
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', type=str, default='config.json',
+                        help='configuration file for hyperparameters loading')
+    common.add_argument('--models', type=str, nargs='+',
+                        help='configurations to benchmark (default: original-fp and ir-fp, original-sd for packed)')
+    common.add_argument('--batch-size', type=int, default=64,
+                        help='batch size used for the benchmark (default: 64)')
+    common.add_argument('--repeats', type=int, default=3,
+                        help='timed repetitions; the best one is reported (default: 3)')
+
+    parser = argparse.ArgumentParser(description='Relation Network benchmarks on synthetic data')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    factorized_parser = subparsers.add_parser('factorized', parents=[common],
+                                              help='dense vs factorized first g layer')
+    factorized_parser.set_defaults(func=bench_factorized)
+    injection_parser = subparsers.add_parser('injection', parents=[common],
+                                             help='concatenated vs broadcast question injection and coordinates')
+    injection_parser.set_defaults(func=bench_injection, default_models=['ir-fp'])
+    tiled_parser = subparsers.add_parser('tiled', parents=[common], help='untiled vs tiled g evaluation')
+    tiled_parser.add_argument('--tile-size', type=int, default=8,
+                              help='number of objects whose pairs are evaluated together (default: 8)')
+    tiled_parser.set_defaults(func=bench_tiled)
+    cached_parser = subparsers.add_parser('cached', parents=[common],
+                                          help='per-question vs per-image inference of question-independent layers')
+    cached_parser.add_argument('--questions-per-image', type=int, default=10,
+                               help='questions asked about every image (default: 10)')
+    cached_parser.set_defaults(func=bench_cached)
+    packed_parser = subparsers.add_parser('packed', parents=[common],
+                                          help='padded vs packed pairs for state descriptions')
+    packed_parser.set_defaults(func=bench_packed, default_models=['original-sd'])
+    questions_parser = subparsers.add_parser('questions', parents=[common],
+                                             help='padding and LSTM time with padded/packed sequences and random/bucketed batches')
+    questions_parser.add_argument('--clevr-dir', type=str,
+                                  help='base directory of CLEVR dataset, to use real question lengths')
+    questions_parser.add_argument('--batches', type=int, default=20,
+                                  help='number of batches to time (default: 20)')
+    questions_parser.set_defaults(func=bench_questions)
+    qcache_parser = subparsers.add_parser('question-cache', parents=[common],
+                                          help='question embedding with and without the embedding cache')
+    qcache_parser.add_argument('--distinct-questions', type=int, default=5000,
+                               help='number of distinct questions batches are drawn from (default: 5000)')
+    qcache_parser.add_argument('--cache-size', type=int, default=100000,
+                               help='maximum number of cached questions (default: 100000)')
+    qcache_parser.add_argument('--batches', type=int, default=50,
+                               help='number of batches to time (default: 50)')
+    qcache_parser.set_defaults(func=bench_question_cache)
+    memory_parser = subparsers.add_parser('worker-memory', parents=[common],
+                                          help='memory of the DataLoader workers along the epochs, failing if it grows (needs the dataset)')
+    memory_parser.add_argument('--clevr-dir', type=str, default='.',
+                               help='base directory of CLEVR dataset')
+    memory_parser.add_argument('--workers', type=int, default=8,
+                               help='number of DataLoader workers (default: 8)')
+    memory_parser.add_argument('--batches', type=int, default=0,
+                               help='number of batches to load per epoch (default: 0, a whole epoch)')
+    memory_parser.add_argument('--epochs', type=int, default=2,
+                               help='number of epochs (default: 2)')
+    memory_parser.add_argument('--max-growth', type=float, default=16,
+                               help='largest growth of private memory of a worker, in MB, for the check to pass (default: 32)')
+    memory_parser.add_argument('--log-interval', type=int, default=100,
+                               help='how many batches to wait before measuring memory (default: 100)')
+    memory_parser.set_defaults(func=bench_worker_memory)
+    bsize_parser = subparsers.add_parser('batch-size', parents=[common],
+                                         help='largest training batch size fitting in a memory budget, and throughput of the probed sizes')
+    bsize_parser.add_argument('--memory-budget', type=float, required=True,
+                              help='MB available for a training step (activations, gradients and optimizer state)')
+    bsize_parser.add_argument('--start-batch-size', type=int, default=16,
+                              help='first batch size probed, doubled until it does not fit (default: 16)')
+    bsize_parser.add_argument('--max-batch-size', type=int, default=4096,
+                              help='largest batch size probed (default: 4096)')
+    bsize_parser.add_argument('--resolution', type=int, default=16,
+                              help='bisection stops when the largest batch size is known within 1/N of it (default: 16)')
+    bsize_parser.add_argument('--question-length', type=int, default=45,
+                              help='length of the synthetic questions (default: 45, longer than all CLEVR questions)')
+    bsize_parser.add_argument('--cuda', action='store_true', default=False,
+                              help='probe GPU memory instead of CPU memory')
+    bsize_parser.add_argument('--output', type=str, default='batch_size_probe.json',
+                              help='file where results are written, for train.py --batch-size-probe (default: batch_size_probe.json)')
+    bsize_parser.set_defaults(func=bench_batch_size, default_models=['original-fp', 'original-sd', 'ir-fp', 'ir-sd'])
+    boundary_parser = subparsers.add_parser('epoch-boundary', parents=[common],
+                                            help='stall at epoch boundaries with restarted vs persistent workers (needs the dataset)')
+    boundary_parser.add_argument('--clevr-dir', type=str, default='.',
+                                 help='base directory of CLEVR dataset')
+    boundary_parser.add_argument('--workers', type=int, default=8,
+                                 help='number of DataLoader workers (default: 8)')
+    boundary_parser.add_argument('--epochs', type=int, default=4,
+                                 help='number of epochs; the batch size doubles at every epoch (default: 4)')
+    boundary_parser.add_argument('--batches', type=int, default=5,
+                                 help='number of batches loaded per epoch (default: 5)')
+    boundary_parser.set_defaults(func=bench_epoch_boundary)
+    ddp_parser = subparsers.add_parser('ddp', parents=[common],
+                                       help='training throughput with DistributedDataParallel (gloo) and 1 to N processes')
+    ddp_parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help='numbers of processes to run (default: 1 2 4 8)')
+    ddp_parser.add_argument('--steps', type=int, default=10,
+                            help='timed training steps (default: 10)')
+    ddp_parser.add_argument('--warmup', type=int, default=2,
+                            help='untimed training steps before measuring (default: 2)')
+    ddp_parser.add_argument('--port', type=int, default=29510,
+                            help='first port used for the process group; every run uses the next one (default: 29510)')
+    ddp_parser.set_defaults(func=bench_ddp, default_models=['original-sd'])
+    suite_parser = subparsers.add_parser('suite', help='time and memory of all the components, configurations and sizes')
+    suite_parser.add_argument('--config', type=str, default='config.json',
+                              help='configuration file for hyperparameters loading')
+    suite_parser.add_argument('--models', type=str, nargs='+',
+                              help='configurations to benchmark (default: all the four)')
+    suite_parser.add_argument('--components', type=str, nargs='+', choices=SUITE_COMPONENTS, default=SUITE_COMPONENTS,
+                              help='components to benchmark (default: all)')
+    suite_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64],
+                              help='batch sizes (default: 16 64)')
+    suite_parser.add_argument('--object-counts', type=int, nargs='+', default=[12, 64],
+                              help='objects per scene for relational layer and state descriptions (default: 12 64)')
+    suite_parser.add_argument('--repeats', type=int, default=3,
+                              help='timed repetitions; the best one is reported (default: 3)')
+    suite_parser.add_argument('--output', type=str, default='benchmark_results.json',
+                              help='file where results are written (default: benchmark_results.json)')
+    suite_parser.add_argument('--baseline', type=str,
+                              help='results file of a previous run to compare against')
+    suite_parser.add_argument('--tolerance', type=float, default=0.1,
+                              help='relative slowdown or memory increase over the baseline flagged as regression (default: 0.1)')
+    suite_parser.set_defaults(func=bench_suite, default_models=['original-fp', 'original-sd', 'ir-fp', 'ir-sd'])
+    compare_parser = subparsers.add_parser('compare', help='compare two results files written by suite')
+    compare_parser.add_argument('results', type=str, help='results file to check')
+    compare_parser.add_argument('baseline', type=str, help='baseline results file')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1,
+                                help='relative slowdown or memory increase over the baseline flagged as regression (default: 0.1)')
+    compare_parser.set_defaults(func=bench_compare, models=[])
+    args = parser.parse_args()
+    if args.models is None:
+        args.models = getattr(args, 'default_models', ['original-fp', 'ir-fp'])
+    args.func(args)
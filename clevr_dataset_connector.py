@@ -1,61 +1,300 @@
+import hashlib
 import json
 import os
 import pickle
+import numpy as np
 from PIL import Image
 
-from collections import Counter
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.sampler import BatchSampler
 
 import utils
 import torch
 
+# scenes are padded to this number of objects
+MAX_OBJECTS = 12
+
+class ClevrImageStore(object):
+    """
+    Read-only access to the images written by 'preprocess.py images': all the train and val images,
+    already resized to 128x128, are kept as uint8 in a single .npy file which is memory-mapped,
+    so that all the DataLoader workers share the same page cache.
+    """
+    array_filename = 'CLEVR_images_128x128.npy'
+    index_filename = 'CLEVR_images_128x128_index.json'
+
+    def __init__(self, clevr_dir, train):
+        array_path, index_path = ClevrImageStore.paths(clevr_dir)
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)['train' if train else 'val']
+        self.array_path = array_path
+        self.offset = index['offset']
+        self.count = index['count']
+        self.array = None
+
+    @staticmethod
+    def paths(clevr_dir):
+        images_dir = os.path.join(clevr_dir, 'images')
+        return (os.path.join(images_dir, ClevrImageStore.array_filename),
+                os.path.join(images_dir, ClevrImageStore.index_filename))
+
+    @staticmethod
+    def exists(clevr_dir):
+        return all(os.path.exists(p) for p in ClevrImageStore.paths(clevr_dir))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, image_index):
+        # the file is mapped lazily, so that every worker process maps it by itself
+        if self.array is None:
+            self.array = np.load(self.array_path, mmap_mode='r')
+        return self.array[self.offset + image_index]  # (128 x 128 x 3), uint8
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['array'] = None
+        return state
+
+class ClevrFeatureStore(ClevrImageStore):
+    """
+    Read-only access to the outputs of the convolutional layers for all the train and val images,
+    written by build_conv_features in train.py as float32 (24 x 8 x 8) arrays in a single memory-mapped
+    .npy file. Files are named after a hash of the weights of the layers that computed them.
+    """
+    def __init__(self, clevr_dir, key, train):
+        array_path, index_path = ClevrFeatureStore.paths(clevr_dir, key)
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)['train' if train else 'val']
+        self.array_path = array_path
+        self.offset = index['offset']
+        self.count = index['count']
+        self.array = None
+
+    @staticmethod
+    def weights_key(conv):
+        """
+        Hash of the weights (and batch norm statistics) of the convolutional layers.
+        """
+        digest = hashlib.sha1()
+        for name, tensor in sorted(conv.state_dict().items()):
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def paths(clevr_dir, key):
+        images_dir = os.path.join(clevr_dir, 'images')
+        return (os.path.join(images_dir, 'CLEVR_conv_features_{}.npy'.format(key)),
+                os.path.join(images_dir, 'CLEVR_conv_features_{}_index.json'.format(key)))
+
+    @staticmethod
+    def exists(clevr_dir, key):
+        return all(os.path.exists(p) for p in ClevrFeatureStore.paths(clevr_dir, key))
+
+class ClevrQuestionStore(object):
+    """
+    Questions of a CLEVR split, tokenized once and packed into flat arrays. They are saved as .npy files
+    next to the questions json and memory-mapped, so that getting a sample only slices them:
+        tokens          word indexes of all the questions, one after the other (int32)
+        offsets         question i is tokens[offsets[i]:offsets[i+1]] (int64)
+        answers         answer index of every question (int32)
+        image_indexes   index of the image every question is about (int32)
+    Being plain arrays instead of python objects, they are never copied in the DataLoader workers
+    by reference counting.
+    """
+    columns = ['tokens', 'offsets', 'answers', 'image_indexes']
+
+    def __init__(self, clevr_dir, train, dictionaries):
+        quest_json_filename = questions_json_filename(clevr_dir, train)
+        self.prefix = quest_json_filename.replace('.json', '')
+        if all(os.path.exists(self.path(c)) for c in ClevrQuestionStore.columns):
+            print('==> using packed questions: {}_*.npy'.format(self.prefix))
+        else:
+            self.build(load_questions(quest_json_filename), dictionaries)
+        self.arrays = None
+        self.n = len(self.column('offsets')) - 1
+
+    def path(self, column):
+        return '{}_{}.npy'.format(self.prefix, column)
+
+    def build(self, questions, dictionaries):
+        print('packing tokenized questions in {}_*.npy...'.format(self.prefix))
+        offsets = np.zeros(len(questions) + 1, dtype=np.int64)
+        answers = np.zeros(len(questions), dtype=np.int32)
+        image_indexes = np.zeros(len(questions), dtype=np.int32)
+        tokens = []
+        for i, q in enumerate(questions):
+            question = utils.to_dictionary_indexes(dictionaries[0], q['question'])
+            tokens.extend(question.tolist())
+            offsets[i + 1] = len(tokens)
+            answers[i] = utils.to_dictionary_indexes(dictionaries[1], q['answer'])[0]
+            image_indexes[i] = q['image_index']
+
+        arrays = dict(tokens=np.array(tokens, dtype=np.int32), offsets=offsets,
+                      answers=answers, image_indexes=image_indexes)
+        for column, array in arrays.items():
+            # write and rename, so that a partially written store is never picked up
+            with open(self.path(column) + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.rename(self.path(column) + '.tmp', self.path(column))
+
+    def column(self, name):
+        # arrays are mapped lazily, so that every worker process maps them by itself
+        if self.arrays is None:
+            self.arrays = {c: np.load(self.path(c), mmap_mode='r') for c in ClevrQuestionStore.columns}
+        return self.arrays[name]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def __len__(self):
+        return self.n
+
+    def question(self, idx):
+        offsets = self.column('offsets')
+        tokens = self.column('tokens')[offsets[idx]:offsets[idx + 1]]
+        return torch.from_numpy(tokens.astype(np.int64))
+
+    def answer(self, idx):
+        return torch.LongTensor([int(self.column('answers')[idx])])
+
+    def image_index(self, idx):
+        return int(self.column('image_indexes')[idx])
+
+    def padded_questions(self, indexes):
+        """
+        Questions at the given indexes, zero-padded to the longest one: (B x max_len) LongTensor.
+        """
+        offsets = self.column('offsets')
+        starts = offsets[indexes]
+        lengths = offsets[indexes + 1] - starts
+        positions = np.arange(lengths.max())
+        mask = positions[None, :] < lengths[:, None]
+        tokens = self.column('tokens')[np.where(mask, starts[:, None] + positions[None, :], 0)]
+        return torch.from_numpy(np.where(mask, tokens, 0).astype(np.int64))
+
+    def lengths(self, indexes=None):
+        """
+        Number of tokens of the questions at the given indexes (of all the questions by default).
+        """
+        offsets = self.column('offsets')
+        if indexes is None:
+            return torch.from_numpy(np.diff(offsets))
+        return torch.from_numpy(offsets[indexes + 1] - offsets[indexes])
+
+    def answers(self, indexes):
+        return torch.from_numpy(self.column('answers')[indexes].astype(np.int64)).unsqueeze(1)
+
+def questions_json_filename(clevr_dir, train):
+    return os.path.join(clevr_dir, 'questions', 'CLEVR_{}_questions.json'.format('train' if train else 'val'))
+
+def load_questions(quest_json_filename):
+    cached_questions = quest_json_filename.replace('.json', '.pkl')
+    if os.path.exists(cached_questions):
+        print('==> using cached questions: {}'.format(cached_questions))
+        with open(cached_questions, 'rb') as f:
+            questions = pickle.load(f)
+    else:
+        with open(quest_json_filename, 'r') as json_file:
+            questions = json.load(json_file)['questions']
+        with open(cached_questions, 'wb') as f:
+            pickle.dump(questions, f)
+    return questions
+
 class ClevrDataset(Dataset):
-    def __init__(self, clevr_dir, train, dictionaries, transform=None):
+    def __init__(self, clevr_dir, train, dictionaries, transform=None, image_store=None, feature_store=None):
         """
         Args:
             clevr_dir (string): Root directory of CLEVR dataset
 			train (bool): Tells if we are loading the train or the validation datasets
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            image_store (ClevrImageStore, optional): Preprocessed images to use instead of the png files.
+                Images are already resized, so transform should not resize them.
+            feature_store (ClevrFeatureStore, optional): Outputs of the convolutional layers to use instead
+                of the images. No transform is applied to them.
         """
-        if train:
-            quest_json_filename = os.path.join(clevr_dir, 'questions', 'CLEVR_train_questions.json')
-            self.img_dir = os.path.join(clevr_dir, 'images', 'train')
-        else:
-            quest_json_filename = os.path.join(clevr_dir, 'questions', 'CLEVR_val_questions.json')
-            self.img_dir = os.path.join(clevr_dir, 'images', 'val')
-
-        cached_questions = quest_json_filename.replace('.json', '.pkl')
-        if os.path.exists(cached_questions):
-            print('==> using cached questions: {}'.format(cached_questions))
-            with open(cached_questions, 'rb') as f:
-                self.questions = pickle.load(f)
-        else:
-            with open(quest_json_filename, 'r') as json_file:
-                self.questions = json.load(json_file)['questions']
-            with open(cached_questions, 'wb') as f:
-                pickle.dump(self.questions, f)
+        self.mode = 'train' if train else 'val'
+        self.img_dir = os.path.join(clevr_dir, 'images', self.mode)
+        self.question_store = ClevrQuestionStore(clevr_dir, train, dictionaries)
                 
         self.clevr_dir = clevr_dir
         self.transform = transform
         self.dictionaries = dictionaries
+        self.image_store = image_store
+        self.feature_store = feature_store
+        # (seed, epoch) of the random transforms, set by set_epoch. It lives in shared memory,
+        # so that persistent DataLoader workers see the changes made by the main process
+        self.augmentation_state = torch.LongTensor([0, -1]).share_memory_()
+
+    def set_epoch(self, epoch, seed=0):
+        """
+        From now on, the random transforms of every sample depend only on seed, epoch and the index
+        of the sample, and not on the worker loading it: an interrupted epoch can be resumed exactly.
+        """
+        self.augmentation_state[0] = seed
+        self.augmentation_state[1] = epoch
     
     def answer_weights(self):
-        n = float(len(self.questions))
-        answer_count = Counter(q['answer'].lower() for q in self.questions)
-        weights = [n/answer_count[q['answer'].lower()] for q in self.questions]
-        return weights
+        answers = self.question_store.column('answers')
+        n = float(len(answers))
+        answer_count = np.bincount(answers)
+        weights = n / answer_count[answers]
+        return weights.tolist()
     
     def __len__(self):
-        return len(self.questions)
+        return len(self.question_store)
+
+    def image_indexes(self):
+        return self.question_store.column('image_indexes')
+
+    def question_lengths(self):
+        return self.question_store.lengths()
+
+    def load_image(self, img_idx, sample_idx=None):
+        # labelled, so that image loading shows up when data loading is profiled
+        with torch.profiler.record_function('ClevrDataset.load_image'):
+            if self.feature_store is not None:
+                return torch.from_numpy(np.array(self.feature_store[img_idx]))
+            if self.image_store is not None:
+                image = Image.fromarray(self.image_store[img_idx])
+            else:
+                img_filename = os.path.join(self.img_dir, 'CLEVR_{}_{}.png'.format(self.mode, str(img_idx).rjust(6, '0')))
+                image = Image.open(img_filename).convert('RGB')
+            if self.transform:
+                seed, epoch = self.augmentation_state.tolist()
+                if sample_idx is None or epoch < 0:
+                    image = self.transform(image)
+                else:
+                    with torch.random.fork_rng(devices=[]):
+                        torch.manual_seed(int(np.random.SeedSequence([seed, epoch, sample_idx]).generate_state(1)[0]))
+                        image = self.transform(image)
+        return image
+
+    def get_grouped(self, indexes):
+        """
+        Loads the samples at the given indexes, reading every image only once.
+        Samples about the same image share the same image object.
+        """
+        images = {}
+        samples = []
+        for idx in indexes:
+            img_idx = self.question_store.image_index(idx)
+            if img_idx not in images:
+                images[img_idx] = self.load_image(img_idx)
+            question = self.question_store.question(idx)
+            answer = self.question_store.answer(idx)
+            samples.append({'image': images[img_idx], 'question': question, 'answer': answer, 'image_index': img_idx})
+        return samples
 
     def __getitem__(self, idx):
-        current_question = self.questions[idx]
-        img_filename = os.path.join(self.img_dir, current_question['image_filename'])
-        image = Image.open(img_filename).convert('RGB')
+        image = self.load_image(self.question_store.image_index(idx), idx)
 
-        question = utils.to_dictionary_indexes(self.dictionaries[0], current_question['question'])
-        answer = utils.to_dictionary_indexes(self.dictionaries[1], current_question['answer'])
+        question = self.question_store.question(idx)
+        answer = self.question_store.answer(idx)
         '''if self.dictionaries[2][answer[0]]=='color':
             image = Image.open(img_filename).convert('L')
             image = numpy.array(image)
@@ -64,9 +303,6 @@ class ClevrDataset(Dataset):
             image = Image.fromarray(image.astype('uint8'), 'RGB')'''
         
         sample = {'image': image, 'question': question, 'answer': answer}
-
-        if self.transform:
-            sample['image'] = self.transform(sample['image'])
         
         return sample
 
@@ -74,28 +310,19 @@ class ClevrDatasetStateDescription(Dataset):
     def __init__(self, clevr_dir, train, dictionaries):
         
         if train:
-            quest_json_filename = os.path.join(clevr_dir, 'questions', 'CLEVR_train_questions.json')
             scene_json_filename = os.path.join(clevr_dir, 'scenes', 'CLEVR_train_scenes.json')
         else:
-            quest_json_filename = os.path.join(clevr_dir, 'questions', 'CLEVR_val_questions.json')
             scene_json_filename = os.path.join(clevr_dir, 'scenes', 'CLEVR_val_scenes.json')
 
-        cached_questions = quest_json_filename.replace('.json', '.pkl')
-        cached_scenes = scene_json_filename.replace('.json', '.pkl')
-        if os.path.exists(cached_questions):
-            print('==> using cached questions: {}'.format(cached_questions))
-            with open(cached_questions, 'rb') as f:
-                self.questions = pickle.load(f)
-        else:
-            with open(quest_json_filename, 'r') as json_file:
-                self.questions = json.load(json_file)['questions']
-            with open(cached_questions, 'wb') as f:
-                pickle.dump(self.questions, f)
+        # objects of all the scenes, zero-padded to MAX_OBJECTS: (N x 12 x 7), plus the number of objects of every scene
+        cached_objects = scene_json_filename.replace('.json', '_objects.npy')
+        cached_counts = scene_json_filename.replace('.json', '_object_counts.npy')
+        # datasets of scenes only do not need the questions
+        if dictionaries is not None:
+            self.question_store = ClevrQuestionStore(clevr_dir, train, dictionaries)
                 
-        if os.path.exists(cached_scenes):
-            print('==> using cached scenes: {}'.format(cached_scenes))
-            with open(cached_scenes, 'rb') as f:
-                self.objects = pickle.load(f)
+        if os.path.exists(cached_objects) and os.path.exists(cached_counts):
+            print('==> using cached scenes: {}'.format(cached_objects))
         else:
             all_scene_objs = []
             with open(scene_json_filename, 'r') as json_file:
@@ -116,10 +343,19 @@ class ClevrDatasetStateDescription(Dataset):
                                 if attr=='3d_coords':
                                     attr_values.extend(obj[attr])
                         objects_attr.append(attr_values)
-                    all_scene_objs.append(torch.FloatTensor(objects_attr))
-                self.objects = all_scene_objs
-            with open(cached_scenes, 'wb') as f:
-                pickle.dump(all_scene_objs, f)
+                    all_scene_objs.append(objects_attr)
+
+            n_attrs = max(len(obj) for objects_attr in all_scene_objs for obj in objects_attr)
+            padded_objects = np.zeros((len(all_scene_objs), MAX_OBJECTS, n_attrs), dtype=np.float32)
+            object_counts = np.zeros(len(all_scene_objs), dtype=np.int64)
+            for i, objects_attr in enumerate(all_scene_objs):
+                padded_objects[i, :len(objects_attr)] = objects_attr
+                object_counts[i] = len(objects_attr)
+            np.save(cached_objects, padded_objects)
+            np.save(cached_counts, object_counts)
+
+        self.objects = torch.from_numpy(np.load(cached_objects))
+        self.object_counts = torch.from_numpy(np.load(cached_counts))
                 
         self.clevr_dir = clevr_dir
         self.dictionaries = dictionaries
@@ -131,16 +367,47 @@ class ClevrDatasetStateDescription(Dataset):
         return weights'''
     
     def __len__(self):
-        return len(self.questions)
+        return len(self.question_store)
+
+    def image_indexes(self):
+        return self.question_store.column('image_indexes')
+
+    def question_lengths(self):
+        return self.question_store.lengths()
+
+    def get_grouped(self, indexes):
+        samples = []
+        for idx in indexes:
+            sample = self[idx]
+            sample['image_index'] = self.question_store.image_index(idx)
+            sample['object_count'] = self.object_counts[sample['image_index']]
+            samples.append(sample)
+        return samples
+
+    def get_batch(self, indexes):
+        """
+        Builds the whole mini-batch at the given indexes by fancy indexing,
+        giving the same result as collating the single samples with utils.collate_samples_state_description,
+        plus the number of real objects of every scene in 'object_count'.
+        """
+        with torch.profiler.record_function('ClevrDatasetStateDescription.get_batch'):
+            indexes = np.asarray(indexes)
+            scene_indexes = torch.from_numpy(self.question_store.column('image_indexes')[indexes].astype(np.int64))
+            return dict(
+                image=self.objects[scene_indexes],
+                answer=self.question_store.answers(indexes),
+                question=self.question_store.padded_questions(indexes),
+                question_length=self.question_store.lengths(indexes),
+                object_count=self.object_counts[scene_indexes]
+            )
 
     def __getitem__(self, idx):
-        current_question = self.questions[idx]
-        scene_idx = current_question['image_index']
+        scene_idx = self.question_store.image_index(idx)
         obj = self.objects[scene_idx]
         
         
-        question = utils.to_dictionary_indexes(self.dictionaries[0], current_question['question'])
-        answer = utils.to_dictionary_indexes(self.dictionaries[1], current_question['answer'])
+        question = self.question_store.question(idx)
+        answer = self.question_store.answer(idx)
         '''if self.dictionaries[2][answer[0]]=='color':
             image = Image.open(img_filename).convert('L')
             image = numpy.array(image)
@@ -152,31 +419,176 @@ class ClevrDatasetStateDescription(Dataset):
         
         return sample
 
+class ImageGroupedDataset(Dataset):
+    """
+    Wraps a question dataset so that it is indexed by a list of question indexes
+    (as yielded by ImageGroupedBatchSampler), returning the corresponding samples
+    with every image loaded only once.
+    To be used in a DataLoader with batch_size=None.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indexes):
+        return self.dataset.get_grouped(indexes)
+
+class BatchedDataset(Dataset):
+    """
+    Wraps a dataset implementing get_batch(), so that it is indexed by a list of indexes
+    (as yielded by a BatchSampler) and returns the whole mini-batch at once.
+    To be used in a DataLoader with batch_size=None.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indexes):
+        return self.dataset.get_batch(indexes)
+
+class ResizableBatchSampler(BatchSampler):
+    """
+    BatchSampler whose batch size can be changed between epochs with set_batch_size.
+    Batches are built in the main process, so DataLoader workers do not need to be restarted.
+    The order of every epoch is fixed by seed and epoch (see set_epoch), and set_start skips
+    the first batches of the next epoch without loading them, to resume an interrupted epoch.
+    """
+    def __init__(self, sampler, batch_size, drop_last, seed=0):
+        super(ResizableBatchSampler, self).__init__(sampler, batch_size, drop_last)
+        self.seed = seed
+        self.start_batch = 0
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            # DistributedSampler shuffles with its own seed and the epoch
+            self.sampler.set_epoch(epoch)
+        elif getattr(self.sampler, 'generator', None) is not None:
+            self.sampler.generator.manual_seed(self.seed + epoch)
+
+    def set_start(self, batch):
+        self.start_batch = batch
+
+    def __iter__(self):
+        indexes = list(self.sampler)
+        start, self.start_batch = self.start_batch * self.batch_size, 0
+        for i in range(start, len(indexes), self.batch_size):
+            batch = indexes[i:i + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                yield batch
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yields shuffled batches of indexes of questions with similar length, reducing padding.
+    Indexes are shuffled and split in pools of pool_batches batches; every pool is sorted by question
+    length and cut in batches, which are then shuffled again.
+    Like ResizableBatchSampler, it can be resized, seeded by epoch and started from a given batch.
+    """
+    def __init__(self, lengths, batch_size, pool_batches=100, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.pool_batches = pool_batches
+        self.seed = seed
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        self.start_batch = 0
+        self.set_batch_size(batch_size)
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+        self.pool_size = batch_size * self.pool_batches
+
+    def set_epoch(self, epoch):
+        self.generator.manual_seed(self.seed + epoch)
+
+    def set_start(self, batch):
+        self.start_batch = batch
+
+    def __iter__(self):
+        order = torch.randperm(len(self.lengths), generator=self.generator).numpy()
+        batches = []
+        for pool_start in range(0, len(order), self.pool_size):
+            pool = order[pool_start:pool_start + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        start, self.start_batch = self.start_batch, 0
+        for i in torch.randperm(len(batches), generator=self.generator).tolist()[start:]:
+            yield batches[i]
+
+    def __len__(self):
+        n_pools, last_pool = divmod(len(self.lengths), self.pool_size)
+        return n_pools * ((self.pool_size + self.batch_size - 1) // self.batch_size) + \
+            (last_pool + self.batch_size - 1) // self.batch_size
+
+class ImageGroupedBatchSampler(Sampler):
+    """
+    Yields batches of question indexes such that all the questions about the same image
+    are in the same batch (unless they are more than batch_size).
+    Images are visited in increasing image index.
+    """
+    def __init__(self, image_indexes, batch_size):
+        # questions sorted by image, and where every image starts and ends in this order
+        image_indexes = np.asarray(image_indexes)
+        order = np.argsort(image_indexes, kind='stable')
+        bounds = np.flatnonzero(np.diff(image_indexes[order])) + 1
+        bounds = np.concatenate(([0], bounds, [len(order)]))
+
+        self.batches = []
+        start = 0
+        for group_start, group_end in zip(bounds[:-1], bounds[1:]):
+            if group_end - start > batch_size and group_start > start:
+                self.batches.append(order[start:group_start])
+                start = group_start
+            while group_end - start > batch_size:
+                self.batches.append(order[start:start + batch_size])
+                start += batch_size
+        if start < len(order):
+            self.batches.append(order[start:])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
 class ClevrDatasetImages(Dataset):
     """
     Loads only images from the CLEVR dataset
     """
 
-    def __init__(self, clevr_dir, train, transform=None):
+    def __init__(self, clevr_dir, train, transform=None, image_store=None):
         """
         :param clevr_dir: Root directory of CLEVR dataset
         :param mode: Specifies if we want to read in val, train or test folder
         :param transform: Optional transform to be applied on a sample.
+        :param image_store: Optional ClevrImageStore to use instead of the png files.
         """
         self.mode = 'train' if train else 'val'
         self.img_dir = os.path.join(clevr_dir, 'images', self.mode)
         self.transform = transform
+        self.image_store = image_store
 
     def __len__(self):
+        if self.image_store is not None:
+            return len(self.image_store)
         return len(os.listdir(self.img_dir))
 
     def __getitem__(self, idx):
-        padded_index = str(idx).rjust(6, '0')
-        img_filename = os.path.join(self.img_dir, 'CLEVR_{}_{}.png'.format(self.mode,padded_index))
-        image = Image.open(img_filename).convert('RGB')
+        with torch.profiler.record_function('ClevrDatasetImages.__getitem__'):
+            if self.image_store is not None:
+                image = Image.fromarray(self.image_store[idx])
+            else:
+                padded_index = str(idx).rjust(6, '0')
+                img_filename = os.path.join(self.img_dir, 'CLEVR_{}_{}.png'.format(self.mode,padded_index))
+                image = Image.open(img_filename).convert('RGB')
 
-        if self.transform:
-            image = self.transform(image)
+            if self.transform:
+                image = self.transform(image)
 
         return image
 
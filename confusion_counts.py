@@ -0,0 +1,39 @@
+"""
+Confusion counts files written by train.py at every test epoch. Only numpy is needed to read them.
+"""
+import os
+
+import numpy as np
+
+
+CONFUSION_COUNTS_VERSION = 1
+
+def confusion_counts_filename(test_results_dir, epoch):
+    return os.path.join(test_results_dir, 'confusion_epoch_{:03d}.npz'.format(epoch))
+
+def save_confusion_counts(filename, counts, labels, epoch):
+    """
+    Stores the (answers x answers) confusion counts of a test epoch: counts[t, p] is the number
+    of questions with answer labels[t] predicted as labels[p].
+    """
+    np.savez_compressed(filename, version=CONFUSION_COUNTS_VERSION, epoch=epoch,
+                        counts=np.asarray(counts, dtype=np.int64), labels=np.asarray(labels))
+
+def load_confusion_counts(filename):
+    """
+    Returns (counts, labels, epoch) stored by save_confusion_counts.
+    """
+    with np.load(filename) as f:
+        version = int(f['version'])
+        if version != CONFUSION_COUNTS_VERSION:
+            raise ValueError('Confusion counts file {} has version {}, expected {}'.format(filename, version, CONFUSION_COUNTS_VERSION))
+        return f['counts'], f['labels'].tolist(), int(f['epoch'])
+
+def align_counts(cm, labels, target_labels):
+    """
+    Reorders the rows and columns of cm, labelled with labels, as target_labels.
+    The label order of train.py changes from run to run (it depends on string hashes).
+    """
+    assert sorted(labels) == sorted(target_labels), 'Confusion matrices have different labels'
+    order = [list(labels).index(l) for l in target_labels]
+    return cm[np.ix_(order, order)]
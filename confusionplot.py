@@ -5,18 +5,41 @@ import argparse
 import matplotlib
 import os
 
-from sklearn.metrics import confusion_matrix
+import confusion_counts
 
 
+def load_confusion_counts(filename):
+    """
+    Returns (counts, labels) from a confusion counts file written by train.py,
+    or from an old test.pickle storing the answer of every question.
+    """
+    if filename.endswith('.npz'):
+        counts, labels, epoch = confusion_counts.load_confusion_counts(filename)
+        print('Loaded confusion counts of epoch {} from {}'.format(epoch, filename))
+        return counts, labels
+
+    with open(filename, 'rb') as f:
+        p = pickle.load(f)
+    labels = p['confusion_matrix_labels']
+    target = np.asarray(p['confusion_matrix_target'])
+    pred = np.asarray(p['confusion_matrix_pred'])
+    n = len(labels)
+    counts = np.bincount(target * n + pred, minlength=n*n).reshape(n, n)
+    return counts, labels
+
+def normalize_counts(cm):
+    # answers never seen in the test set have an all-zero row
+    return cm.astype('float') / np.maximum(cm.sum(axis=1), 1)[:, np.newaxis]
+
 def plot_confusion_matrix(cm, classes, cmap,
                           normalize=False,
-                          title='Confusion matrix'):
+                          title='Confusion matrix', vmin=None, vmax=None):
     """
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
     """
     if normalize:
-        cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+        cm = normalize_counts(cm)
         print("Normalized confusion matrix")
     else:
         print('Confusion matrix, without normalization')
@@ -24,7 +47,7 @@ def plot_confusion_matrix(cm, classes, cmap,
     print(cm)
 
     fig, ax = plt.subplots()
-    im = ax.imshow(cm, interpolation='nearest', cmap=cmap)
+    im = ax.imshow(cm, interpolation='nearest', cmap=cmap, vmin=vmin, vmax=vmax)
     fig.colorbar(im)
     ax.set_title(title)
     tick_marks = np.arange(len(classes))
@@ -42,7 +65,8 @@ def plot_confusion_matrix(cm, classes, cmap,
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='Plot RN confusion matrix')
-  parser.add_argument('file', type=str, help='Stat file to use for plotting')
+  parser.add_argument('file', type=str, help='Confusion counts file (test_results/confusion_epoch_N.npz) or test.pickle to use for plotting')
+  parser.add_argument('--diff', type=str, help='Another confusion counts file: plot the difference of the normalized matrices (file - diff)')
   parser.add_argument('--no-show', action='store_true', help='Do not show plot, store only on file')
   args = parser.parse_args()
 
@@ -57,20 +81,28 @@ if __name__ == '__main__':
   import matplotlib.pyplot as plt
 
   # Load stats file
-  filename = open(args.file, 'rb')
-  p = pickle.load(filename)
-  target = p['confusion_matrix_target']
-  pred = p['confusion_matrix_pred']
-  class_names = p['confusion_matrix_labels']
-
-  # Compute confusion matrix
-  cnf_matrix = confusion_matrix(target, pred)
+  cnf_matrix, class_names = load_confusion_counts(args.file)
   np.set_printoptions(precision=2)
 
-  # Plot normalized confusion matrix
-  plot_confusion_matrix(cnf_matrix, classes=class_names, cmap=plt.cm.Blues, normalize=True,
-                        title='Normalized confusion matrix')
+  if args.diff:
+    other_matrix, other_names = load_confusion_counts(args.diff)
+    other_matrix = confusion_counts.align_counts(other_matrix, other_names, class_names)
+    diff = normalize_counts(cnf_matrix) - normalize_counts(other_matrix)
+
+    # largest changes first
+    for idx in np.argsort(-np.abs(diff), axis=None)[:10]:
+      t, p = np.unravel_index(idx, diff.shape)
+      print('{} predicted as {}: {:+.2%}'.format(class_names[t], class_names[p], diff[t, p]))
+
+    limit = max(np.abs(diff).max(), 1e-6)
+    plot_confusion_matrix(diff, classes=class_names, cmap=plt.cm.RdBu, title='Normalized confusion matrix difference',
+                          vmin=-limit, vmax=limit)
+    plt.savefig(os.path.join(args.img_dir, 'confusion_diff.png'))
+  else:
+    # Plot normalized confusion matrix
+    plot_confusion_matrix(cnf_matrix, classes=class_names, cmap=plt.cm.Blues, normalize=True,
+                          title='Normalized confusion matrix')
+    plt.savefig(os.path.join(args.img_dir, 'confusion.png'))
 
-  plt.savefig(os.path.join(args.img_dir, 'confusion.png'))
   if not args.no_show:
     plt.show()
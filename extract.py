@@ -17,7 +17,7 @@ from torchvision import transforms
 from tqdm import tqdm
 
 import utils
-from clevr_dataset_connector import ClevrDatasetImages, ClevrDatasetImagesStateDescription
+from clevr_dataset_connector import ClevrDatasetImages, ClevrDatasetImagesStateDescription, ClevrImageStore
 from model import RN
 
 import pdb
@@ -99,6 +99,8 @@ def extract_features_rl(data, quest_inject_index, extr_layer_idx, lstm_emb_size,
 
     
     h = extraction_layer.register_forward_hook(hook_function)
+    if args.profiler is not None:
+        args.profiler.step(0)
     for batch_idx, sample_batched in enumerate(progress_bar):
         qst = torch.LongTensor(len(sample_batched), 1).zero_()
         qst = Variable(qst)
@@ -117,8 +119,12 @@ def extract_features_rl(data, quest_inject_index, extr_layer_idx, lstm_emb_size,
         maxconv_features.append((batch_idx, maxconvf))
         #with open('features/noaggr-{}.gz'.format(batch_idx),'wb') as f:
         #    np.savetxt(f, np.reshape(noaggf, (args.batch_size,4096*256)), fmt='%.6e')
+        if args.profiler is not None:
+            args.profiler.step(batch_idx + 1)
 
     h.remove()
+    if args.profiler is not None:
+        args.profiler.finish()
 
     if lay=='g_layers':
         pickle.dump(max_features, files_dict['max_features'])
@@ -128,24 +134,31 @@ def extract_features_rl(data, quest_inject_index, extr_layer_idx, lstm_emb_size,
         pickle.dump(avgconv_features, files_dict['avgconv_features'])
         pickle.dump(maxconv_features, files_dict['maxconv_features'])
 
-def reload_loaders(clevr_dataset, bs, state_description = False): #TODO here: add custom collect function
+def reload_loaders(clevr_dataset, bs, state_description = False, num_workers = 8): #TODO here: add custom collect function
     if not state_description:
 
         # Initialize Clevr dataset loader
         clevr_loader = DataLoader(clevr_dataset, batch_size=bs,
-                                       shuffle=False, num_workers=8, drop_last=True)
+                                       shuffle=False, num_workers=num_workers, drop_last=True)
     else:
         # Initialize Clevr dataset loader
         clevr_loader = DataLoader(clevr_dataset, batch_size=bs,
-                                       shuffle=False, num_workers=1, collate_fn=utils.collate_samples_images_state_description, drop_last=True)
+                                       shuffle=False, num_workers=min(num_workers, 1), collate_fn=utils.collate_samples_images_state_description, drop_last=True)
     return clevr_loader
 
 def initialize_dataset(clevr_dir, train=False, state_description=True):
     if not state_description:
-        test_transforms = transforms.Compose([transforms.Resize((128, 128)),
-                                          transforms.ToTensor()])
+        if ClevrImageStore.exists(clevr_dir):
+            # images preprocessed by 'preprocess.py images' are already resized
+            print('==> using preprocessed images: {}'.format(ClevrImageStore.paths(clevr_dir)[0]))
+            test_transforms = transforms.ToTensor()
+            image_store = ClevrImageStore(clevr_dir, train)
+        else:
+            test_transforms = transforms.Compose([transforms.Resize((128, 128)),
+                                              transforms.ToTensor()])
+            image_store = None
                                           
-        clevr_dataset_test = ClevrDatasetImages(clevr_dir, train, test_transforms)
+        clevr_dataset_test = ClevrDatasetImages(clevr_dir, train, test_transforms, image_store)
         
     else:
         clevr_dataset_test = ClevrDatasetImagesStateDescription(clevr_dir, False)
@@ -169,7 +182,11 @@ def main(args):
 
     # Initialize CLEVR Loader
     clevr_dataset_test  = initialize_dataset(args.clevr_dir, True if args.set=='train' else False, hyp['state_description'])
-    clevr_feat_extraction_loader = reload_loaders(clevr_dataset_test, args.batch_size, hyp['state_description'])
+    # with --profile-data, data is loaded in the main process, where the profiler can see it
+    clevr_feat_extraction_loader = reload_loaders(clevr_dataset_test, args.batch_size, hyp['state_description'], 0 if args.profile_data else 8)
+    args.profiler = None
+    if args.profile_steps:
+        args.profiler = utils.StepProfiler(args.profile_steps, './profiles', 'extract', args.cuda)
 
     args.features_dirs = './features'
     if not os.path.exists(args.features_dirs):
@@ -208,16 +225,11 @@ def main(args):
 
     # Load the model checkpoint
     print('==> loading checkpoint {}'.format(args.checkpoint))
-    checkpoint = torch.load(args.checkpoint, map_location=lambda storage, loc: storage)
+    # full-state checkpoints written by train.py also contain optimizer and random states
+    checkpoint = utils.checkpoint_model_state(torch.load(args.checkpoint, map_location=lambda storage, loc: storage, weights_only=False))
 
-    #removes 'module' from dict entries, pytorch bug #3805
-    #removes 'module' from dict entries, pytorch bug #3805
-    if torch.cuda.device_count() == 1 and any(k.startswith('module.') for k in checkpoint.keys()):
-        print('Removing \'module.\' prefix') 
-        checkpoint = {k.replace('module.',''): v for k,v in checkpoint.items()}
-    if torch.cuda.device_count() > 1 and not any(k.startswith('module.') for k in checkpoint.keys()):
-        print('Adding \'module.\' prefix') 
-        checkpoint = {'module.'+k: v for k,v in checkpoint.items()}
+    #adds or removes 'module' from dict entries, pytorch bug #3805
+    checkpoint = utils.adapt_state_dict(checkpoint, model)
 
     model.load_state_dict(checkpoint)
     print('==> loaded checkpoint {}'.format(args.checkpoint))
@@ -246,5 +258,9 @@ if __name__ == '__main__':
                         help='At which stage of g function the question should be inserted (0 to insert at the beginning, as specified in DeepMind model, -1 to use configuration value)')
     parser.add_argument('--extr-layer-idx', type=int, default=2, 
                         help='From which stage of g function features are extracted')
+    parser.add_argument('--profile-steps', type=utils.parse_profile_steps,
+                        help='profile extraction iterations from N to M (excluded) given as N:M, writing a trace and a summary into ./profiles')
+    parser.add_argument('--profile-data', action='store_true', default=False,
+                        help='load data in the main process (no DataLoader workers), so that data loading is profiled too')
     args = parser.parse_args()
     main(args)
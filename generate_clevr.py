@@ -0,0 +1,200 @@
+"""
+Generates a small synthetic dataset with the same layout and file formats as CLEVR_v1.0
+(questions/, scenes/ and images/ directories), so that train.py, extract.py and cnn_train.py
+can be run and benchmarked without downloading the real dataset.
+Images are 480x320 png files with flat 2D shapes, and questions are consistent with the scenes.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+from functools import partial
+from multiprocessing import Pool
+
+from PIL import Image, ImageDraw
+from tqdm import tqdm
+
+import utils
+
+IMAGE_WIDTH, IMAGE_HEIGHT = 480, 320
+
+COLORS = {
+    'gray': (87, 87, 87), 'red': (173, 35, 35), 'blue': (42, 75, 215), 'green': (29, 105, 20),
+    'brown': (129, 74, 25), 'purple': (129, 38, 192), 'cyan': (41, 208, 208), 'yellow': (255, 238, 51)
+}
+# radius in pixels and height of the object center in the 3d scene
+SIZES = {'large': (34, 0.7), 'small': (17, 0.35)}
+
+ATTRIBUTES = ['size', 'color', 'material', 'shape']
+
+
+def random_scene(rng, image_index, split, min_objects, max_objects):
+    objects = []
+    for _ in range(rng.randint(min_objects, max_objects)):
+        obj = {attr: rng.choice(utils.classes[attr]) for attr in ATTRIBUTES}
+        radius, z = SIZES[obj['size']]
+        x, y = rng.uniform(-3, 3), rng.uniform(-3, 3)
+        # simple perspective-free projection of the ground plane on the image
+        pixel_x = int(IMAGE_WIDTH / 2 + x * (IMAGE_WIDTH / 2 - radius) / 3)
+        pixel_y = int(IMAGE_HEIGHT / 2 + y * (IMAGE_HEIGHT / 2 - radius) / 3)
+        obj['3d_coords'] = [x, y, z]
+        obj['pixel_coords'] = [pixel_x, pixel_y, 10.0 - y]
+        obj['rotation'] = rng.uniform(0, 360)
+        objects.append(obj)
+
+    return {
+        'image_index': image_index,
+        'image_filename': 'CLEVR_{}_{}.png'.format(split, str(image_index).rjust(6, '0')),
+        'split': split,
+        'objects': objects,
+        'relationships': {'left': [], 'right': [], 'front': [], 'behind': []},
+        'directions': {}
+    }
+
+
+def render_scene(scene, img_dir):
+    image = Image.new('RGB', (IMAGE_WIDTH, IMAGE_HEIGHT), (128, 128, 128))
+    draw = ImageDraw.Draw(image)
+    # farther objects first
+    for obj in sorted(scene['objects'], key=lambda o: -o['pixel_coords'][2]):
+        x, y = obj['pixel_coords'][:2]
+        r, _ = SIZES[obj['size']]
+        color = COLORS[obj['color']]
+        # metal objects are outlined in white, rubber ones in black
+        outline = (235, 235, 235) if obj['material'] == 'metal' else (20, 20, 20)
+        if obj['shape'] == 'sphere':
+            draw.ellipse([x - r, y - r, x + r, y + r], fill=color, outline=outline)
+        elif obj['shape'] == 'cube':
+            draw.rectangle([x - r, y - r, x + r, y + r], fill=color, outline=outline)
+        else:
+            draw.rectangle([x - r, y - r // 2, x + r, y + r], fill=color, outline=outline)
+            draw.ellipse([x - r, y - r, x + r, y], fill=color, outline=outline)
+    image.save(os.path.join(img_dir, scene['image_filename']))
+
+
+def describe(obj, attributes):
+    words = [obj[attr] for attr in attributes if attr != 'shape']
+    return ' '.join(words + [obj['shape'] if 'shape' in attributes else 'object'])
+
+
+def random_question(rng, scene):
+    """
+    Returns (question, answer, family) about scene, drawn from a few CLEVR-like templates.
+    """
+    objects = scene['objects']
+    family = rng.randrange(4)
+    if family == 0:
+        # exist
+        attributes = rng.sample(ATTRIBUTES, 2)
+        template = rng.choice(objects) if rng.random() < 0.5 else {attr: rng.choice(utils.classes[attr]) for attr in ATTRIBUTES}
+        exists = any(all(o[a] == template[a] for a in attributes) for o in objects)
+        return 'Are there any {}s?'.format(describe(template, attributes)), 'yes' if exists else 'no', family
+    if family == 1:
+        # count
+        if rng.random() < 0.2:
+            return 'How many objects are there?', str(len(objects)), family
+        attr = rng.choice(ATTRIBUTES)
+        value = rng.choice(utils.classes[attr])
+        count = sum(o[attr] == value for o in objects)
+        target = {attr: value}
+        return 'How many {}s are there?'.format(describe(target, [attr])), str(count), family
+    if family == 2:
+        # query an attribute of an object described by the other ones
+        obj = rng.choice(objects)
+        attr = rng.choice(ATTRIBUTES)
+        others = [a for a in ATTRIBUTES if a != attr]
+        return 'What is the {} of the {}?'.format(attr, describe(obj, others)), obj[attr], family
+    # compare the attribute of two objects
+    obj1, obj2 = rng.choice(objects), rng.choice(objects)
+    attr = rng.choice(['size', 'color', 'material', 'shape'])
+    return 'Does the {} have the same {} as the {}?'.format(describe(obj1, ['size', 'color']), attr, describe(obj2, ['material', 'shape'])), \
+        'yes' if obj1[attr] == obj2[attr] else 'no', family
+
+
+def generate_split(args, split, n_images, rng, pool, known_questions=None):
+    """
+    Writes scenes, questions and images of split. If known_questions (the training questions) are given,
+    only questions made of words and answers they contain are kept, since dictionaries are built on them.
+    """
+    img_dir = os.path.join(args.output_dir, 'images', split)
+    if not os.path.exists(img_dir):
+        os.makedirs(img_dir)
+
+    scenes = [random_scene(rng, i, split, args.min_objects, args.max_objects) for i in range(n_images)]
+    if known_questions is not None:
+        words = set(w for q in known_questions for w in utils.tokenize(q['question']))
+        answers = set(q['answer'] for q in known_questions)
+
+    questions = []
+    for scene in scenes:
+        for _ in range(args.questions_per_image):
+            for _ in range(100):
+                question, answer, family = random_question(rng, scene)
+                if known_questions is None or (answer in answers and words.issuperset(utils.tokenize(question))):
+                    break
+            else:
+                continue
+            questions.append({
+                'image_index': scene['image_index'],
+                'image_filename': scene['image_filename'],
+                'split': split,
+                'question_index': len(questions),
+                'question_family_index': family,
+                'question': question,
+                'answer': answer
+            })
+
+    info = {'split': split, 'version': '1.0', 'license': 'synthetic'}
+    with open(os.path.join(args.output_dir, 'scenes', 'CLEVR_{}_scenes.json'.format(split)), 'w') as f:
+        json.dump({'info': info, 'scenes': scenes}, f)
+    with open(os.path.join(args.output_dir, 'questions', 'CLEVR_{}_questions.json'.format(split)), 'w') as f:
+        json.dump({'info': info, 'questions': questions}, f)
+
+    for _ in tqdm(pool.imap(partial(render_scene, img_dir=img_dir), scenes, chunksize=16), total=len(scenes),
+                  desc='rendering {} images'.format(split)):
+        pass
+    return questions
+
+
+def main(args):
+    assert 3 <= args.min_objects <= args.max_objects <= 10, 'Scenes have from 3 to 10 objects, as in CLEVR'
+    for d in ['questions', 'scenes', 'images']:
+        path = os.path.join(args.output_dir, d)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    rng = random.Random(args.seed)
+    pool = Pool(args.workers)
+    train_questions = generate_split(args, 'train', args.train_images, rng, pool)
+    generate_split(args, 'val', args.val_images, rng, pool, train_questions)
+    pool.close()
+
+    # the answers dictionary is built from the training questions: all the answers should be there
+    missing = set(a for values in utils.classes.values() for a in values) - set(q['answer'] for q in train_questions)
+    if missing:
+        print('==> warning: answers never used in training questions: {}'.format(sorted(missing)))
+    print('==> synthetic CLEVR dataset written to {}'.format(args.output_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic dataset in CLEVR format')
+    parser.add_argument('output_dir', type=str,
+                        help='directory where the dataset is created (to be used as --clevr-dir)')
+    parser.add_argument('--train-images', type=int, default=1000,
+                        help='number of training images (default: 1000)')
+    parser.add_argument('--val-images', type=int, default=200,
+                        help='number of validation images (default: 200)')
+    parser.add_argument('--questions-per-image', type=int, default=10,
+                        help='number of questions about every image (default: 10)')
+    parser.add_argument('--min-objects', type=int, default=3,
+                        help='minimum number of objects in a scene (default: 3)')
+    parser.add_argument('--max-objects', type=int, default=10,
+                        help='maximum number of objects in a scene (default: 10)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of processes rendering images (default: 4)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='random seed (default: 42)')
+    args = parser.parse_args()
+    main(args)
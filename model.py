@@ -1,9 +1,11 @@
 import os
+from collections import OrderedDict
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence
+from torch.utils.checkpoint import checkpoint
 import math
 
 class ConvInputModel(nn.Module):
@@ -36,6 +38,82 @@ class ConvInputModel(nn.Module):
         return x
 
 
+class QuestionEmbeddingCache(object):
+    """
+    Bounded LRU cache of question embeddings, keyed on the token indexes fed to the LSTM.
+    CLEVR questions come from templates, so many of them are repeated word by word.
+    Entries are dropped as soon as the weights of the question model change (optimizer steps,
+    checkpoint loading, moving to another device), and hit counts restart with them: during
+    a test pass they refer to that pass only.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.weights_signature = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hit_rate(), size=len(self.entries))
+
+    def check_weights(self, model):
+        # in-place updates of a parameter bump its version, replacing it changes its storage
+        signature = tuple((p.data_ptr(), p._version) for p in model.parameters())
+        if signature != self.weights_signature:
+            self.clear()
+            self.weights_signature = signature
+
+    def embed(self, model, question, lengths=None):
+        """
+        Question embeddings (B x 128) of question, computing with model only those not in the cache.
+        Without lengths, padding is part of the LSTM input and so of the key.
+        """
+        self.check_weights(model)
+        tokens = question.cpu().numpy()
+        if lengths is None:
+            keys = [row.tobytes() for row in tokens]
+        else:
+            keys = [row[:l].tobytes() for row, l in zip(tokens, lengths.tolist())]
+
+        embeddings = [None] * len(keys)
+        missing = OrderedDict()
+        for idx, key in enumerate(keys):
+            emb = self.entries.get(key)
+            if emb is not None:
+                self.entries.move_to_end(key)
+                embeddings[idx] = emb
+                self.hits += 1
+            else:
+                # repeated questions inside the batch are computed only once
+                if key in missing:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                missing.setdefault(key, []).append(idx)
+
+        if missing:
+            rows = torch.LongTensor([idxs[0] for idxs in missing.values()]).to(question.device)
+            missing_lengths = lengths.index_select(0, rows.to(lengths.device)) if lengths is not None else None
+            new_embeddings = model.encode(question.index_select(0, rows), missing_lengths)
+            for (key, idxs), emb in zip(missing.items(), new_embeddings):
+                for idx in idxs:
+                    embeddings[idx] = emb
+                # a row of new_embeddings would keep the storage of the whole batch alive
+                self.entries[key] = emb.detach().clone()
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+        return torch.stack(embeddings)
+
 class QuestionEmbedModel(nn.Module):
     def __init__(self, in_size, embed=32, hidden=128):
         super(QuestionEmbedModel, self).__init__()
@@ -43,11 +121,27 @@ class QuestionEmbedModel(nn.Module):
         self.wembedding = nn.Embedding(in_size + 1, embed)  #word embeddings have size 32
         self.lstm = nn.LSTM(embed, hidden, batch_first=True)  # Input dim is 32, output dim is the question embedding
         self.hidden = hidden
+        self.cache = None
+
+    def enable_cache(self, max_size):
+        """
+        Reuses the embeddings of already seen questions when the model is used for inference only
+        (eval mode, gradients disabled). max_size is the maximum number of cached questions.
+        """
+        self.cache = QuestionEmbeddingCache(max_size) if max_size > 0 else None
         
-    def forward(self, question):
+    def forward(self, question, lengths=None):
+        if self.cache is not None and not self.training and not torch.is_grad_enabled():
+            return self.cache.embed(self, question, lengths)
+        return self.encode(question, lengths)
+
+    def encode(self, question, lengths=None):
         #calculate question embeddings
         wembed = self.wembedding(question)
         # wembed = wembed.permute(1,0,2) # in lstm minibatches are in the 2-nd dimension
+        if lengths is not None:
+            # padding (at the end of every question) is skipped, the hidden state is taken at the last real word
+            wembed = pack_padded_sequence(wembed, lengths.cpu(), batch_first=True, enforce_sorted=False)
         self.lstm.flatten_parameters()
         _, hidden = self.lstm(wembed) # initial state is set to zeros by default
         qst_emb = hidden[0] # hidden state of the lstm. qst = (B x 128)
@@ -100,58 +194,238 @@ class RelationalLayer(RelationalLayerBase):
             self.g_layers.append(l)	
         self.g_layers = nn.ModuleList(self.g_layers)
         self.extraction = extraction
+        # the first g layer can be evaluated without materializing the pair tensor, which saves time.
+        # The following layers still store activations for every pair: memory is bounded by g_tile_size.
+        # Extraction hooks need the real input of the g layers, so there we keep the dense path
+        self.factorized = hyp.get("factorized_g", True) and not extraction
+        # number of objects whose pairs are evaluated together by g (0 to evaluate all the pairs at once).
+        # In training, tiles are recomputed during backward, otherwise autograd would keep all of them
+        self.tile_size = 0 if extraction else hyp.get("g_tile_size", 0)
+        # evaluate g only on pairs of real objects, skipping the padding of state descriptions
+        self.packed_pairs = hyp.get("packed_pairs", False) and not extraction
+        # add the projected question to the pairs instead of concatenating a copy of it to every pair.
+        # Extraction hooks need the real input of the injection layer, so there we keep the concatenation
+        self.broadcast_injection = hyp.get("broadcast_injection", True) and not extraction
     
-    def forward(self, x, qst):
+    def forward(self, x, qst, object_counts=None):
         # x = (B x 8*8 x 24)
         # qst = (B x 128)
         """g"""
         b, d, k = x.size()
         qst_size = qst.size()[1]
-        
-        # add question everywhere
-        qst = torch.unsqueeze(qst, 1)                      # (B x 1 x 128)
-        qst = qst.repeat(1, d, 1)                       # (B x 64 x 128)
-        qst = torch.unsqueeze(qst, 2)                      # (B x 64 x 1 x 128)
-        
-        # cast all pairs against each other
-        x_i = torch.unsqueeze(x, 1)                   # (B x 1 x 64 x 26)
-        x_i = x_i.repeat(1, d, 1, 1)                    # (B x 64 x 64 x 26)
-        x_j = torch.unsqueeze(x, 2)                   # (B x 64 x 1 x 26)
-        #x_j = torch.cat([x_j, qst], 3)
-        x_j = x_j.repeat(1, 1, d, 1)                    # (B x 64 x 64 x 26)
-        
-        # concatenate all together
-        x_full = torch.cat([x_i, x_j], 3)                  # (B x 64 x 64 x 2*26)
-        
-        # reshape for passing through network
-        x_ = x_full.view(b * d**2, self.in_size)
+
+        if self.packed_pairs:
+            x_g = self.packed_g(x, qst, object_counts)
+            return self.f(x_g)
+
+        if self.tile_size > 0:
+            x_g = self.tiled_g(x, qst)
+            return self.f(x_g)
+
+        if self.factorized:
+            x_i, x_j, x_q = self.project_objects(x, qst)
+            x_ = self.combine_projections(x_i, x_j, x_q)
+            x_ = self.process_g(x_, qst, start=1)
+        else:
+            # cast all pairs against each other
+            x_i = torch.unsqueeze(x, 1)                   # (B x 1 x 64 x 26)
+            x_i = x_i.repeat(1, d, 1, 1)                    # (B x 64 x 64 x 26)
+            x_j = torch.unsqueeze(x, 2)                   # (B x 64 x 1 x 26)
+            #x_j = torch.cat([x_j, qst], 3)
+            x_j = x_j.repeat(1, 1, d, 1)                    # (B x 64 x 64 x 26)
+
+            # concatenate all together
+            x_full = torch.cat([x_i, x_j], 3)                  # (B x 64 x 64 x 2*26)
+
+            # reshape for passing through network
+            x_ = x_full.view(b, d**2, self.in_size)
+            x_ = self.process_g(x_, qst)
+
+        if self.extraction:
+            return None
+
+        # sum over all the pairs
+        x_g = x_.sum(1)
+        return self.f(x_g)
+
+    def project_objects(self, x, qst):
+        """
+        Splits the first g layer in the parts acting on the two objects and on the question.
+        Since the layer is linear, W*[x_i, x_j, q] + bias = W_i*x_i + W_j*x_j + W_q*q + bias:
+        every object (and the question) is projected only once.
+        """
+        b, d, k = x.size()
+        g_layer = self.g_layers[0]
+        weight = g_layer.weight
+
+        x_i = F.linear(x, weight[:, :k])                            # (B x 64 x 256)
+        x_j = F.linear(x, weight[:, k:2*k], g_layer.bias)           # (B x 64 x 256)
+        x_q = None
+        if self.quest_inject_position == 0:
+            x_q = F.linear(qst, weight[:, 2*k:])                    # (B x 256)
+        return x_i, x_j, x_q
+
+    def combine_projections(self, x_i, x_j, x_q):
+        """
+        Output of the first g layer for all the pairs between the x_j and the x_i objects,
+        obtained by broadcasting their projections. Returns (B x n_j*n_i x 256)
+        """
+        b = x_i.size()[0]
+        x_ = x_i.unsqueeze(1) + x_j.unsqueeze(2)                    # (B x n_j x n_i x 256)
+        if x_q is not None:
+            x_ = x_ + x_q.view(b, 1, 1, -1)
+        x_ = F.relu(x_)
+        return x_.view(b, -1, self.g_layers_size[0])
+
+    def process_g(self, x_, qst, start=0, stop=None, pair_scene=None):
+        """
+        Runs g layers from the start-th one up to the stop-th one (excluded) on a
+        (B x n_pairs x in) tensor, injecting the question where requested.
+        If pair_scene is given, x_ is instead a (n_pairs x in) tensor of pairs coming from different
+        scenes, and pair_scene (n_pairs) tells the scene (and so the question) of every pair.
+        """
+        if pair_scene is None:
+            b, n = x_.size()[:2]
+            rows = b*n
+        else:
+            rows = x_.size()[0]
 
         #create g and inject the question at the position pointed by quest_inject_position.
         for idx, (g_layer, g_layer_size) in enumerate(zip(self.g_layers, self.g_layers_size)):
+            if idx < start:
+                continue
+            if stop is not None and idx >= stop:
+                break
             if idx==self.quest_inject_position:
                 in_size = self.in_size if idx==0 else self.g_layers_size[idx-1]
 
                 # questions inserted
-                x_img = x_.view(b,d,d,in_size)
-                qst = qst.repeat(1,1,d,1)
-                x_concat = torch.cat([x_img,qst],3) #(B x 64 x 64 x 128+256)
+                x_img = x_.view(rows,in_size)
+                if self.broadcast_injection:
+                    # h layer, split in the parts acting on the pair and on the question:
+                    # every question is projected once and broadcast to its pairs
+                    x_ = F.linear(x_img, g_layer.weight[:, :in_size], g_layer.bias)
+                    x_q = F.linear(qst, g_layer.weight[:, in_size:])                    #(B x 256)
+                    if pair_scene is None:
+                        x_ = x_.view(b, n, -1) + x_q.unsqueeze(1)
+                    else:
+                        x_ = x_ + x_q.index_select(0, pair_scene)
+                    x_ = F.relu(x_)
+                    continue
+
+                if pair_scene is None:
+                    qst_ = qst.view(b,1,self.qst_size).repeat(1,n,1).view(rows,self.qst_size) #(B*64*64 x 128)
+                else:
+                    qst_ = qst.index_select(0, pair_scene)
+                x_concat = torch.cat([x_img,qst_],1) #(B*64*64 x 128+256)
 
                 # h layer
-                x_ = x_concat.view(b*(d**2),in_size+self.qst_size)
-                x_ = g_layer(x_)
+                x_ = g_layer(x_concat)
                 x_ = F.relu(x_)
             else:
-                x_ = g_layer(x_)
+                x_ = g_layer(x_.view(rows, -1))
                 x_ = F.relu(x_)
 
-        if self.extraction:
-            return None
-        
-        # reshape again and sum
-        x_g = x_.view(b, d**2, self.g_layers_size[-1])
-        x_g = x_g.sum(1).squeeze(1)
-        
-        """f"""
+        if pair_scene is not None:
+            return x_
+        return x_.view(b, n, -1)
+
+    def packed_g(self, x, qst, object_counts=None):
+        """
+        Evaluates g only on the pairs of real objects of every scene, skipping the padding,
+        and sums them per scene. Objects of a scene are the first object_counts ones;
+        without object_counts, padding objects are recognized by being all zeros.
+        Returns the (B x 256) sum of g over the real pairs
+        """
+        b, d, k = x.size()
+        if object_counts is None:
+            real = x.abs().sum(2) > 0                                       # (B x 12)
+        else:
+            real = torch.arange(d, device=x.device).unsqueeze(0) < object_counts.unsqueeze(1)
+        pairs = real.unsqueeze(2) & real.unsqueeze(1)                       # (B x 12 x 12)
+        pair_scene, pair_j, pair_i = pairs.nonzero(as_tuple=True)           # (n_pairs)
+
+        x_i, x_j, x_q = self.project_objects(x, qst)
+        x_ = x_i[pair_scene, pair_i] + x_j[pair_scene, pair_j]              # (n_pairs x 512)
+        if x_q is not None:
+            x_ = x_ + x_q.index_select(0, pair_scene)
+        x_ = F.relu(x_)
+        x_ = self.process_g(x_, qst, start=1, pair_scene=pair_scene)
+
+        x_g = x_.new_zeros(b, self.g_layers_size[-1])
+        return x_g.index_add(0, pair_scene, x_)
+
+    def tiled_g(self, x, qst):
+        """
+        Evaluates g on tiles of tile_size*d pairs at a time and accumulates their sum,
+        so that at most one tile of pair activations is alive at a time. When gradients are needed,
+        every tile is recomputed during backward instead of storing its activations.
+        Returns the (B x 256) sum of g over all the pairs
+        """
+        b, d, k = x.size()
+        x_i, x_j, x_q = self.project_objects(x, qst)
+
+        def g_tile(x_i, x_j_tile, qst, *x_q):
+            x_ = self.combine_projections(x_i, x_j_tile, x_q[0] if x_q else None)
+            return self.process_g(x_, qst, start=1).sum(1)
+
+        extra = (x_q,) if x_q is not None else ()
+        x_g = None
+        for start in range(0, d, self.tile_size):
+            x_j_tile = x_j[:, start:start + self.tile_size]
+            if torch.is_grad_enabled():
+                tile_sum = checkpoint(g_tile, x_i, x_j_tile, qst, *extra, use_reentrant=False)
+            else:
+                tile_sum = g_tile(x_i, x_j_tile, qst, *extra)
+            x_g = tile_sum if x_g is None else x_g + tile_sum
+        return x_g
+
+    def image_state(self, x):
+        """
+        Computes everything in g that does not depend on the question, so that it can be
+        shared among all the questions about the same image.
+        For IR models this is the (B x 64*64 x 256) input of the injection layer,
+        otherwise only the objects themselves. With tiles, the pair activations are never
+        stored for the whole image, so the state is the objects too.
+        """
+        if self.quest_inject_position == 0 or self.tile_size > 0:
+            return x
+        if self.factorized:
+            x_i, x_j, _ = self.project_objects(x, None)
+            x_ = self.combine_projections(x_i, x_j, None)
+            return self.process_g(x_, None, start=1, stop=self.quest_inject_position)
+
+        b, d, k = x.size()
+        x_i = torch.unsqueeze(x, 1).repeat(1, d, 1, 1)              # (B x 64 x 64 x 26)
+        x_j = torch.unsqueeze(x, 2).repeat(1, 1, d, 1)              # (B x 64 x 64 x 26)
+        x_ = torch.cat([x_i, x_j], 3).view(b, d**2, self.in_size)
+        return self.process_g(x_, None, stop=self.quest_inject_position)
+
+    def answer(self, state, qst, img_index, object_counts=None):
+        """
+        Answers the questions qst (Q x 128) starting from image_state() of a batch of images;
+        img_index (Q) tells which image every question refers to.
+        With packed_pairs, object_counts (one per image) tell the real objects of every scene,
+        and only their pairs are summed, as in packed_g.
+        """
+        state = state.index_select(0, img_index)
+        if object_counts is not None:
+            object_counts = object_counts.index_select(0, img_index)
+        if self.quest_inject_position == 0 or self.tile_size > 0:
+            # state holds the objects: g runs as in training, in tiles if requested
+            return self.forward(state, qst, object_counts)
+
+        x_ = self.process_g(state, qst, start=self.quest_inject_position)
+        if self.packed_pairs:
+            if object_counts is None:
+                raise ValueError('object_counts are needed to answer from image_state() with packed_pairs')
+            d = int(round(x_.size()[1] ** 0.5))
+            real = torch.arange(d, device=x_.device).unsqueeze(0) < object_counts.unsqueeze(1)   # (Q x 12)
+            pairs = (real.unsqueeze(2) & real.unsqueeze(1)).view(x_.size()[0], -1, 1)           # (Q x 12*12 x 1)
+            x_ = x_ * pairs.to(x_.dtype)
+        return self.f(x_.sum(1))
+
+    def f(self, x_g):
         x_f = self.f_fc1(x_g)
         x_f = F.relu(x_f)
         x_f = self.f_fc2(x_f)
@@ -164,11 +438,15 @@ class RelationalLayer(RelationalLayerBase):
 class RN(nn.Module):
     def __init__(self, args, hyp, extraction=False):
         super(RN, self).__init__()
-        self.coord_tensor = None
         self.on_gpu = False
+        # coordinates of the 8x8 cells of the conv output, shared by all the images of a batch.
+        # Not persistent, so that checkpoints do not change
+        self.register_buffer('coord_tensor', self.build_coord_tensor(8), persistent=False)
         
         # CNN
         self.conv = ConvInputModel()
+        # when True, images are already the (B x 24 x 8 x 8) outputs of self.conv (see --cache-conv-features)
+        self.precomputed_conv = False
         self.state_desc = hyp['state_description']            
             
         # LSTM
@@ -184,38 +462,52 @@ class RN(nn.Module):
         else:     
             print('Supposing original DeepMind model')
 
-    def forward(self, img, qst_idxs):
+    def forward(self, img, qst_idxs, object_counts=None, question_lengths=None):
+        x = self.objects(img)
+        qst = self.text(qst_idxs, question_lengths)
+        y = self.rl(x, qst, object_counts)
+        return y
+
+    def image_state(self, img):
+        """
+        Question-independent part of the network, to be computed once per image.
+        """
+        return self.rl.image_state(self.objects(img))
+
+    def answer(self, state, qst_idxs, img_index, question_lengths=None, object_counts=None):
+        """
+        Answers the questions qst_idxs using image_state() of the images they refer to;
+        img_index tells the position of the image of every question in state.
+        object_counts, if known, are the numbers of real objects of the images in state.
+        """
+        qst = self.text(qst_idxs, question_lengths)
+        return self.rl.answer(state, qst, img_index, object_counts)
+
+    def objects(self, img):
         if self.state_desc:
             x = img # (B x 12 x 8)
         else:
-            x = self.conv(img)  # (B x 24 x 8 x 8)
+            x = img if self.precomputed_conv else self.conv(img)  # (B x 24 x 8 x 8)
             b, k, d, _ = x.size()
             x = x.view(b,k,d*d) # (B x 24 x 8*8)
             
             # add coordinates
-            if self.coord_tensor is None or torch.cuda.device_count() == 1:
-                self.build_coord_tensor(b, d)                  # (B x 2 x 8 x 8)
-                self.coord_tensor = self.coord_tensor.view(b,2,d*d) # (B x 2 x 8*8)
+            if self.coord_tensor.size()[2] != d*d:
+                self.coord_tensor = self.build_coord_tensor(d).to(x.device)       # (1 x 2 x 8*8)
             
-            x = torch.cat([x, self.coord_tensor], 1)    # (B x 24+2 x 8*8)
+            x = torch.cat([x, self.coord_tensor.expand(b, -1, -1)], 1)    # (B x 24+2 x 8*8)
             x = x.permute(0, 2, 1)    # (B x 64 x 24+2)
-        
-        qst = self.text(qst_idxs)
-        y = self.rl(x, qst)
-        return y
+        return x
        
     # prepare coord tensor
-    def build_coord_tensor(self, b, d):
+    @staticmethod
+    def build_coord_tensor(d):
         coords = torch.linspace(-d/2., d/2., d)
         x = coords.unsqueeze(0).repeat(d, 1)
         y = coords.unsqueeze(1).repeat(1, d)
         ct = torch.stack((x,y))
-        # broadcast to all batches
-        # TODO: upgrade pytorch and use broadcasting
-        ct = ct.unsqueeze(0).repeat(b, 1, 1, 1)
-        self.coord_tensor = Variable(ct, requires_grad=False)
-        if self.on_gpu:
-            self.coord_tensor = self.coord_tensor.cuda()
+        # broadcast to all batches with expand()
+        return ct.view(1, 2, d*d)
     
     def cuda(self):
         self.on_gpu = True
@@ -1,6 +1,8 @@
 import re
 import argparse
+import json
 import os
+import time
 import matplotlib
 
 '''def parse_log(log, pattern):
@@ -23,8 +25,50 @@ def parse_log(log, pattern):
                 # inside the pattern (...)
                 yield i, match.group(1)
 
+class MetricsStream(object):
+    """
+    Records of a JSON-lines metrics file written by train.py --metrics-file.
+    update() only parses the lines appended since the previous call.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.records = []
+
+    def update(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # line still being written
+                    break
+                self.records.append(json.loads(line.decode('utf-8')))
+                self.offset += len(line)
+        return self
+
+    def stage(self, stage):
+        return [r for r in self.records if r['stage'] == stage]
+
+def train_losses(args):
+    if args.metrics is not None:
+        return [(r['iteration'], r['loss']) for r in args.metrics.stage('train')]
+    return [(10*n,float(i)) for n,i in parse_log(args.log_file, r'Train loss: (.*)')]
+
+def test_values(args, key, pattern, class_key=None, class_name=None):
+    """
+    Per-epoch test values: from the metrics stream if available, otherwise parsed from the log.
+    Rates are in %, as printed in the log.
+    """
+    if args.metrics is not None:
+        records = args.metrics.stage('test_epoch')
+        scale = 1 if key == 'loss' else 100
+        if class_key is not None:
+            return [scale * r[class_key][class_name] for r in records]
+        return [scale * r[key] for r in records]
+    return [float(i) for _,i in parse_log(args.log_file, pattern)]
+
 def plot_train_loss(args):
-    losses = [(10*n,float(i)) for n,i in parse_log(args.log_file, r'Train loss: (.*)')]
+    losses = train_losses(args)
     plt.clf()
     it, losses = zip(*losses)
     plt.plot(it, losses)
@@ -40,7 +84,7 @@ def plot_train_loss(args):
         plt.show()
 
 def plot_test_loss(args):
-    losses = [float(i) for _,i in parse_log(args.log_file, r'Test loss = (.*)')]
+    losses = test_values(args, 'loss', r'Test loss = (.*)')
     plt.clf()
     plt.plot(losses)
     plt.title('Test Loss')
@@ -56,10 +100,10 @@ def plot_test_loss(args):
 
 
 def plot_accuracy(args):
-    accuracy = [float(i) for _,i in parse_log(args.log_file, r'.* Accuracy = (\d+\.\d+)%')]
+    accuracy = test_values(args, 'accuracy', r'.* Accuracy = (\d+\.\d+)%')
     details = ['exist', 'number', 'material', 'size', 'shape', 'color']
     
-    accs = {k: [float(i) for _,i in parse_log(args.log_file, '{} -- acc: (\d+\.\d+)%'.format(k))]
+    accs = {k: test_values(args, 'accuracy', '{} -- acc: (\d+\.\d+)%'.format(k), 'class_accuracy', k)
             for k in details}
     
     plt.clf()
@@ -77,7 +121,7 @@ def plot_accuracy(args):
         plt.show()
 
 def plot_invalids(args):
-    invalids = [float(i) for _,i in parse_log(args.log_file, r'.* Invalids = (\d+\.\d+)%')]
+    invalids = test_values(args, 'invalids', r'.* Invalids = (\d+\.\d+)%')
     '''details = ['exist', 'number', 'material', 'size', 'shape', 'color']
     
     invds = {k: [float(i) for i in parse_log(log, '.* invalid: (\d+\.\d+)%'.format(k))]
@@ -97,13 +141,43 @@ def plot_invalids(args):
     if not args.no_show:
         plt.show()
 
+def plot_stage_times(args):
+    """
+    Share of the wall time spent waiting for data, in forward, backward, optimizer step, checkpoints and logging,
+    and training throughput. Only available with a metrics stream.
+    """
+    records = args.metrics.stage('train')
+    stages = ['data', 'forward', 'backward', 'optimizer', 'checkpoint', 'logging']
+    it = [r['iteration'] for r in records]
+    totals = [sum(r.get(s + '_time', 0) for s in stages) or 1 for r in records]
+    shares = [[100 * r.get(s + '_time', 0) / t for r, t in zip(records, totals)] for s in stages]
+
+    plt.clf()
+    ax = plt.subplot(2, 1, 1)
+    ax.stackplot(it, *shares, labels=stages)
+    ax.legend(loc='best')
+    ax.set_title('Train step time')
+    ax.set_ylabel('%')
+    ax.grid()
+    ax = plt.subplot(2, 1, 2)
+    ax.plot(it, [r['samples_per_sec'] for r in records])
+    ax.set_xlabel('Iteration')
+    ax.set_ylabel('samples/s')
+    ax.grid()
+    plt.savefig(os.path.join(args.img_dir, 'stage_times.png'))
+    if not args.no_show:
+        plt.show()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Plot RN training logs')
-    parser.add_argument('log_file', type=str, help='Log file to plot')
+    parser.add_argument('log_file', type=str, help='Log file to plot, or JSON-lines metrics file (.jsonl) written by train.py --metrics-file')
     parser.add_argument('-trl', '--train-loss', action='store_true', help='Show training loss plot')
     parser.add_argument('-tsl', '--test-loss', action='store_true', help='Show test loss plot')
     parser.add_argument('-a', '--accuracy', action='store_true', help='Show accuracy plot')
     parser.add_argument('-i', '--invalids', action='store_true', help='Show invalid rate plot')
+    parser.add_argument('-st', '--stage-times', action='store_true', help='Show train time split in stages and throughput (metrics file only)')
+    parser.add_argument('--follow', type=float, default=0,
+                        help='re-read the metrics file every this many seconds and update the plots in imgs/ (metrics file only, 0 to disable)')
     parser.add_argument('--no-show', action='store_true', help='Do not show figures, store only on file')
     parser.add_argument('--y-max', type=float, default=0,
                         help='upper bound for y axis of loss plots (0 to leave default)')
@@ -113,6 +187,8 @@ if __name__ == '__main__':
     
     img_dir = 'imgs/'
     args.img_dir = img_dir
+    # when following, plots are only updated on file
+    args.no_show = args.no_show or args.follow > 0
 
     if args.no_show:
         matplotlib.use('Agg')    
@@ -121,14 +197,26 @@ if __name__ == '__main__':
     if not os.path.exists(img_dir):
         os.makedirs(img_dir)
 
-    if args.train_loss:
-      plot_train_loss(args)
+    args.metrics = MetricsStream(args.log_file).update() if args.log_file.endswith('.jsonl') else None
+    assert args.metrics is not None or not (args.stage_times or args.follow), 'Stage times and --follow need a metrics file'
+
+    while True:
+        if args.train_loss:
+          plot_train_loss(args)
+
+        if args.test_loss:
+          plot_test_loss(args)
+
+        if args.accuracy:
+          plot_accuracy(args)
 
-    if args.test_loss:
-      plot_test_loss(args)
+        if args.invalids:
+          plot_invalids(args)
 
-    if args.accuracy:
-      plot_accuracy(args)
+        if args.stage_times:
+          plot_stage_times(args)
 
-    if args.invalids:
-      plot_invalids(args)
+        if not args.follow:
+            break
+        time.sleep(args.follow)
+        args.metrics.update()
@@ -0,0 +1,84 @@
+"""
+One-time preprocessing of the CLEVR dataset, producing compact files that the datasets
+in clevr_dataset_connector.py read in place of the original json and png files
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+from torchvision import transforms
+from tqdm import tqdm
+
+import utils
+from clevr_dataset_connector import ClevrImageStore, ClevrQuestionStore
+
+resize = transforms.Resize((128, 128))
+
+
+def load_resized(img_filename):
+    image = Image.open(img_filename).convert('RGB')
+    return np.asarray(resize(image), dtype=np.uint8)
+
+
+def preprocess_images(args):
+    """
+    Decodes all train and val images once, resizes them to 128x128 (as the training transforms do)
+    and writes them in a single uint8 .npy file, together with a json index telling
+    where every split starts.
+    """
+    array_path, index_path = ClevrImageStore.paths(args.clevr_dir)
+    index = {}
+    filenames = []
+    for mode in ['train', 'val']:
+        img_dir = os.path.join(args.clevr_dir, 'images', mode)
+        mode_filenames = sorted(f for f in os.listdir(img_dir) if f.endswith('.png'))
+        # images are addressed by their image_index, which must match their position
+        for i, f in enumerate(mode_filenames):
+            assert f == 'CLEVR_{}_{}.png'.format(mode, str(i).rjust(6, '0')), 'Unexpected image file {}'.format(f)
+        index[mode] = {'offset': len(filenames), 'count': len(mode_filenames)}
+        filenames.extend(os.path.join(img_dir, f) for f in mode_filenames)
+
+    tmp_path = array_path + '.tmp'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(filenames), 128, 128, 3))
+    pool = Pool(args.workers)
+    for i, image in enumerate(tqdm(pool.imap(load_resized, filenames, chunksize=64), total=len(filenames))):
+        array[i] = image
+    pool.close()
+    array.flush()
+    del array
+    os.rename(tmp_path, array_path)
+
+    with open(index_path, 'w') as index_file:
+        json.dump(index, index_file)
+    print('==> {} images written to {}'.format(len(filenames), array_path))
+
+
+def preprocess_questions(args):
+    """
+    Tokenizes the train and val questions once and packs them in memory-mappable arrays
+    """
+    print('Building word dictionaries from all the words in the dataset...')
+    dictionaries = utils.build_dictionaries(args.clevr_dir)
+    for train in [True, False]:
+        ClevrQuestionStore(args.clevr_dir, train, dictionaries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess the CLEVR dataset')
+    parser.add_argument('--clevr-dir', type=str, default='.',
+                        help='base directory of CLEVR dataset')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of processes used for preprocessing (default: 8)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('images', help='resize all the images and store them in a memory-mapped array') \
+        .set_defaults(func=preprocess_images)
+    subparsers.add_parser('questions', help='tokenize all the questions and pack them in flat arrays') \
+        .set_defaults(func=preprocess_questions)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,32 @@
+"""
+Batch size probe of benchmark.py
+"""
+import pytest
+import torch
+
+import benchmark
+from test_model import CONFIG
+
+
+@pytest.mark.parametrize('error', [
+    RuntimeError('DefaultCPUAllocator: can\'t allocate memory: you tried to allocate 68719476736 bytes.'),
+    RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB'),
+    torch.cuda.OutOfMemoryError('CUDA out of memory.'),
+    MemoryError(),
+])
+def test_probe_step_stops_on_out_of_memory(monkeypatch, error):
+    def allocate(fn):
+        raise error
+    monkeypatch.setattr(benchmark, 'peak_bytes', allocate)
+    hyp = benchmark.load_hyp(CONFIG, 'original-sd')
+    assert benchmark.probe_step(hyp, 4, 10, False, 1) == (None, None)
+
+
+def test_probe_step_raises_other_errors(monkeypatch):
+    def fail(fn):
+        raise RuntimeError('shape mismatch')
+    monkeypatch.setattr(benchmark, 'peak_bytes', fail)
+    hyp = benchmark.load_hyp(CONFIG, 'original-sd')
+    with pytest.raises(RuntimeError, match='shape mismatch'):
+        benchmark.probe_step(hyp, 4, 10, False, 1)
+
@@ -0,0 +1,42 @@
+"""
+Confusion counts files and their alignment for confusionplot.py --diff
+"""
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import confusion_counts
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def test_save_and_load(tmp_path):
+    counts = np.arange(9).reshape(3, 3)
+    filename = confusion_counts.confusion_counts_filename(str(tmp_path), 7)
+    confusion_counts.save_confusion_counts(filename, counts, ['yes', 'no', '2'], 7)
+    loaded, labels, epoch = confusion_counts.load_confusion_counts(filename)
+    assert np.array_equal(loaded, counts)
+    assert labels == ['yes', 'no', '2'] and epoch == 7
+
+
+def test_align_counts_reorders_rows_and_columns():
+    labels = ['cube', 'red', 'yes', '3']
+    counts = np.random.RandomState(0).randint(0, 100, (4, 4))
+    # the same matrix, written by a run with another label order
+    order = [2, 0, 3, 1]
+    shuffled = counts[np.ix_(order, order)]
+    shuffled_labels = [labels[i] for i in order]
+    assert np.array_equal(confusion_counts.align_counts(shuffled, shuffled_labels, labels), counts)
+
+
+def test_align_counts_rejects_different_labels():
+    with pytest.raises(AssertionError):
+        confusion_counts.align_counts(np.zeros((2, 2)), ['yes', 'no'], ['yes', 'cube'])
+
+
+def test_reading_does_not_need_torch():
+    code = 'import sys, confusion_counts; assert "torch" not in sys.modules'
+    subprocess.check_call([sys.executable, '-c', code], cwd=REPO)
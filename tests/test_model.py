@@ -0,0 +1,146 @@
+"""
+Parity of the alternative evaluations of g with the dense one, on small synthetic batches
+"""
+import argparse
+import json
+import os
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from model import RN
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.json')
+MODELS = ['original-fp', 'original-sd', 'ir-fp', 'ir-sd']
+QDICT_SIZE = 80
+ADICT_SIZE = 28
+
+
+def load_hyp(model_name, **overrides):
+    with open(CONFIG) as config_file:
+        hyp = json.load(config_file)['hyperparams'][model_name]
+    hyp.update(overrides)
+    return hyp
+
+
+def build_model(hyp, state_dict=None):
+    torch.manual_seed(0)
+    model = RN(argparse.Namespace(qdict_size=QDICT_SIZE, adict_size=ADICT_SIZE), hyp)
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+    # no dropout, and batch norm uses its running statistics: outputs are deterministic.
+    # Double precision, so that differences in the summation order of the pairs do not matter
+    model.eval()
+    return model.double()
+
+
+def synthetic_batch(hyp, batch_size=3, n_objects=12, qst_len=10):
+    torch.manual_seed(1)
+    if hyp['state_description']:
+        img = torch.randn(batch_size, n_objects, hyp['rl_in_size'] // 2, dtype=torch.float64)
+    else:
+        img = torch.randn(batch_size, 3, 128, 128, dtype=torch.float64)
+    qst = torch.randint(1, QDICT_SIZE + 1, (batch_size, qst_len), dtype=torch.long)
+    label = torch.randint(0, ADICT_SIZE, (batch_size,), dtype=torch.long)
+    return img, qst, label
+
+
+def output_and_grads(model, img, qst, label, object_counts=None):
+    model.zero_grad()
+    output = model(img, qst, object_counts)
+    F.nll_loss(output, label).backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+    return output.detach(), grads
+
+
+def assert_same_step(reference, other, img, qst, label, object_counts=None):
+    ref_output, ref_grads = output_and_grads(reference, img, qst, label, object_counts)
+    output, grads = output_and_grads(other, img, qst, label, object_counts)
+    torch.testing.assert_close(output, ref_output)
+    assert grads.keys() == ref_grads.keys()
+    for name in ref_grads:
+        torch.testing.assert_close(grads[name], ref_grads[name], msg=name)
+
+
+@pytest.mark.parametrize('model_name', MODELS)
+def test_factorized_matches_dense(model_name):
+    dense = build_model(load_hyp(model_name, factorized_g=False))
+    factorized = build_model(load_hyp(model_name, factorized_g=True), dense.state_dict())
+    assert not dense.rl.factorized and factorized.rl.factorized
+    img, qst, label = synthetic_batch(load_hyp(model_name))
+    assert_same_step(dense, factorized, img, qst, label)
+
+
+@pytest.mark.parametrize('model_name', MODELS)
+@pytest.mark.parametrize('tile_size', [1, 5])
+def test_tiled_matches_dense(model_name, tile_size):
+    # tile sizes that do not divide the number of objects leave a smaller last tile
+    dense = build_model(load_hyp(model_name, factorized_g=False))
+    tiled = build_model(load_hyp(model_name, g_tile_size=tile_size), dense.state_dict())
+    img, qst, label = synthetic_batch(load_hyp(model_name))
+    assert_same_step(dense, tiled, img, qst, label)
+
+
+@pytest.mark.parametrize('model_name', ['original-sd', 'ir-sd'])
+@pytest.mark.parametrize('use_counts', [True, False])
+def test_packed_pairs_match_unpadded_scenes(model_name, use_counts):
+    # packed g on padded scenes equals dense g on every scene cut to its real objects
+    dense = build_model(load_hyp(model_name, factorized_g=False))
+    packed = build_model(load_hyp(model_name, packed_pairs=True), dense.state_dict())
+    img, qst, label = synthetic_batch(load_hyp(model_name), batch_size=4)
+    object_counts = torch.tensor([3, 12, 1, 7])
+    img = img * (torch.arange(img.size(1)).unsqueeze(0) < object_counts.unsqueeze(1)).unsqueeze(2)
+
+    packed.zero_grad()
+    output = packed(img, qst, object_counts if use_counts else None)
+    F.nll_loss(output, label, reduction='sum').backward()
+
+    dense.zero_grad()
+    dense_output = []
+    for scene, count in enumerate(object_counts.tolist()):
+        scene_output = dense(img[scene:scene + 1, :count], qst[scene:scene + 1])
+        F.nll_loss(scene_output, label[scene:scene + 1], reduction='sum').backward()
+        dense_output.append(scene_output.detach())
+
+    torch.testing.assert_close(output.detach(), torch.cat(dense_output))
+    for (name, p), (_, dense_p) in zip(packed.named_parameters(), dense.named_parameters()):
+        if dense_p.grad is not None:
+            torch.testing.assert_close(p.grad, dense_p.grad, msg=name)
+
+
+@pytest.mark.parametrize('model_name', MODELS)
+@pytest.mark.parametrize('overrides', [{}, dict(factorized_g=False), dict(g_tile_size=5), dict(packed_pairs=True)],
+                         ids=['factorized', 'dense', 'tiled', 'packed'])
+def test_answer_from_image_state_matches_forward(model_name, overrides):
+    hyp = load_hyp(model_name, **overrides)
+    if overrides.get('packed_pairs') and not hyp['state_description']:
+        pytest.skip('packed pairs are meant for padded state descriptions')
+    model = build_model(hyp)
+    img, _, _ = synthetic_batch(hyp, batch_size=3)
+    _, qst, _ = synthetic_batch(hyp, batch_size=6)
+    img_index = torch.tensor([0, 0, 1, 2, 2, 2])
+    object_counts = None
+    if hyp['state_description']:
+        object_counts = torch.tensor([4, 12, 9])
+        img = img * (torch.arange(img.size(1)).unsqueeze(0) < object_counts.unsqueeze(1)).unsqueeze(2)
+
+    with torch.no_grad():
+        expected = model(img.index_select(0, img_index), qst,
+                         object_counts.index_select(0, img_index) if object_counts is not None else None)
+        output = model.answer(model.image_state(img), qst, img_index, None, object_counts)
+    torch.testing.assert_close(output, expected)
+
+
+def test_answer_from_image_state_runs_in_tiles(monkeypatch):
+    # grouped answering of IR models must not build the state of all the pairs when tiles are requested
+    model = build_model(load_hyp('ir-sd', g_tile_size=4))
+    img, qst, _ = synthetic_batch(load_hyp('ir-sd'), batch_size=2)
+    calls = []
+    tiled_g = model.rl.tiled_g
+    monkeypatch.setattr(model.rl, 'tiled_g', lambda x, q: calls.append(x.size()) or tiled_g(x, q))
+    with torch.no_grad():
+        state = model.image_state(img)
+        model.answer(state, qst, torch.tensor([0, 1]))
+    assert state.size() == img.size()
+    assert calls == [img.size()]
@@ -0,0 +1,105 @@
+"""
+Training resumed from a checkpoint follows the same trajectory as an uninterrupted run.
+Runs train.py on a small synthetic dataset built by generate_clevr.py.
+"""
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+import torch
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TRAIN_ARGS = ['--model', 'ir-sd', '--epochs', '2', '--batch-size', '8', '--test-batch-size', '64',
+              '--no-cuda', '--config', os.path.join(REPO, 'config.json'), '--log-interval', '1000']
+
+
+@pytest.fixture(scope='module')
+def clevr_dir(tmp_path_factory):
+    clevr_dir = str(tmp_path_factory.mktemp('clevr'))
+    subprocess.check_call([sys.executable, os.path.join(REPO, 'generate_clevr.py'), clevr_dir, '--train-images', '40',
+                           '--val-images', '4', '--questions-per-image', '8', '--workers', '1'],
+                          stdout=subprocess.DEVNULL)
+    return clevr_dir
+
+
+def train(clevr_dir, run_dir, *args):
+    os.makedirs(run_dir, exist_ok=True)
+    return subprocess.Popen([sys.executable, os.path.join(REPO, 'train.py'), '--clevr-dir', clevr_dir] + TRAIN_ARGS + list(args),
+                            cwd=run_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def finish(process):
+    _, err = process.communicate()
+    assert process.returncode == 0, err.decode()
+
+
+def checkpoint(run_dir, name):
+    return torch.load(glob.glob(os.path.join(run_dir, 'model_*', name))[0], weights_only=False)
+
+
+def assert_same_state(a, b):
+    assert (a['epoch'], a['batch'], a['train_iteration']) == (b['epoch'], b['batch'], b['train_iteration'])
+    for k in a['model']:
+        assert torch.equal(a['model'][k], b['model'][k]), k
+    assert a['scheduler'] == b['scheduler']
+    state_a, state_b = a['optimizer']['state'], b['optimizer']['state']
+    assert state_a.keys() == state_b.keys()
+    for p in state_a:
+        for k in state_a[p]:
+            assert torch.equal(state_a[p][k], state_b[p][k]), (p, k)
+
+
+@pytest.fixture(scope='module')
+def reference(clevr_dir, tmp_path_factory):
+    """
+    An uninterrupted run with frequent mid-epoch checkpoints, and a copy of one of them
+    taken while the run goes on.
+    """
+    run_dir = str(tmp_path_factory.mktemp('reference'))
+    process = train(clevr_dir, run_dir, '--checkpoint-steps', '7')
+    mid_epoch = os.path.join(run_dir, 'mid_epoch.pth')
+    while process.poll() is None and not os.path.exists(mid_epoch):
+        latest = glob.glob(os.path.join(run_dir, 'model_*', 'RN_latest.pth'))
+        if latest:
+            # the file is replaced atomically, so it is always whole
+            state = torch.load(latest[0], weights_only=False)
+            if state['batch'] > 0:
+                torch.save(state, mid_epoch)
+        time.sleep(0.05)
+    finish(process)
+    assert os.path.exists(mid_epoch), 'no mid-epoch checkpoint was seen'
+    return run_dir, mid_epoch
+
+
+def test_resume_from_epoch_checkpoint(clevr_dir, reference, tmp_path):
+    run_dir, _ = reference
+    resumed = str(tmp_path / 'resumed')
+    os.makedirs(resumed)
+    shutil.copy(glob.glob(os.path.join(run_dir, 'model_*', 'RN_epoch_01.pth'))[0], os.path.join(resumed, 'RN_epoch_01.pth'))
+    finish(train(clevr_dir, resumed, '--resume', 'RN_epoch_01.pth'))
+    assert_same_state(checkpoint(run_dir, 'RN_epoch_02.pth'), checkpoint(resumed, 'RN_epoch_02.pth'))
+
+
+def test_resume_from_mid_epoch_checkpoint(clevr_dir, reference, tmp_path):
+    run_dir, mid_epoch = reference
+    resumed = str(tmp_path / 'resumed')
+    finish(train(clevr_dir, resumed, '--resume', mid_epoch))
+    assert_same_state(checkpoint(run_dir, 'RN_epoch_02.pth'), checkpoint(resumed, 'RN_epoch_02.pth'))
+
+
+def test_resume_with_cached_conv_features(clevr_dir, tmp_path):
+    run_dir = str(tmp_path / 'trained')
+    finish(train(clevr_dir, run_dir, '--model', 'original-fp', '--epochs', '1'))
+    trained = checkpoint(run_dir, 'RN_epoch_01.pth')
+    resumed = str(tmp_path / 'resumed')
+    finish(train(clevr_dir, resumed, '--model', 'original-fp', '--resume', glob.glob(os.path.join(run_dir, 'model_*', 'RN_epoch_01.pth'))[0],
+                 '--cache-conv-features'))
+    state = checkpoint(resumed, 'RN_epoch_02.pth')
+    assert state['optimizer']['param_groups'][0]['params'] == trained['optimizer']['param_groups'][0]['params']
+    for k in trained['model']:
+        if k.startswith('conv.') and 'num_batches_tracked' not in k:
+            assert torch.equal(trained['model'][k], state['model'][k]), k
@@ -0,0 +1,29 @@
+"""
+Training helpers of train.py
+"""
+import pytest
+import torch
+
+import train
+from test_model import build_model, load_hyp
+
+
+@pytest.mark.parametrize('model_name', ['original-sd', 'ir-sd'])
+def test_activation_bytes_of_packed_pairs(model_name):
+    # packed pairs evaluate g on real objects only: the estimate must count full scenes, not padding
+    dense = build_model(load_hyp(model_name)).float()
+    packed = build_model(load_hyp(model_name, packed_pairs=True)).float()
+    dense_bytes = train.sample_activation_bytes(dense, True, dense.rl_in_size, False)
+    packed_bytes = train.sample_activation_bytes(packed, True, packed.rl_in_size, False)
+    assert packed_bytes > 0.5 * dense_bytes
+
+
+def test_activation_bytes_leave_model_unchanged():
+    model = build_model(load_hyp('original-fp')).float()
+    model.train()
+    before = {k: v.clone() for k, v in model.state_dict().items()}
+    rng = torch.get_rng_state()
+    train.sample_activation_bytes(model, False, model.rl_in_size, False)
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, before[k]), k
+    assert torch.equal(torch.get_rng_state(), rng)
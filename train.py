@@ -4,10 +4,14 @@ Pytorch implementation of "A simple neural network module for relational reasoni
 from __future__ import print_function
 
 import argparse
+import contextlib
+import copy
+import datetime
 import json
 import os
 import pickle
 import re
+import time
 import numpy as np
 
 import torch
@@ -15,13 +19,20 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim import lr_scheduler
 from torch.nn.utils import clip_grad_norm
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.sampler import BatchSampler, RandomSampler, SequentialSampler
 from torchvision import transforms
 from tqdm import tqdm, trange
 
 import utils
 import math
-from clevr_dataset_connector import ClevrDataset, ClevrDatasetStateDescription
+from clevr_dataset_connector import ClevrDataset, ClevrDatasetStateDescription, ClevrImageStore, BatchedDataset, ImageGroupedDataset, ImageGroupedBatchSampler, \
+    LengthBucketBatchSampler, ResizableBatchSampler, \
+    ClevrFeatureStore, ClevrDatasetImages, MAX_OBJECTS
 from model import RN
 
 import pdb
@@ -31,15 +42,46 @@ def train(data, model, optimizer, scheduler, epoch, args):
 
     avg_loss = 0.0
     n_batches = 0
-    progress_bar = tqdm(data)
-    for batch_idx, sample_batched in enumerate(progress_bar):
-        img, qst, label = utils.load_tensor_data(sample_batched, args.cuda, args.invert_questions)
-
-        # forward and backward pass
+    interval_samples = 0
+    timer = utils.StageTimer(sync=args.cuda and args.metrics is not None)
+    if args.profiler is not None:
+        args.profiler.step(args.train_iteration)
+    # a resumed epoch starts after the batches already done, which are not even loaded
+    start_batch, args.resume_batch = args.resume_batch, 0
+    train_batch_sampler(data).set_start(start_batch)
+    # in distributed training only the first process reports progress
+    progress_bar = tqdm(data, initial=start_batch, disable=args.rank != 0)
+    for batch_idx, sample_batched in enumerate(progress_bar, start_batch):
+        img, qst, label = utils.load_tensor_data(sample_batched, args.cuda, args.invert_questions, packed_questions=args.packed_questions)
+        object_counts = utils.load_object_counts(sample_batched, args.cuda)
+        qst_lengths = utils.load_question_lengths(sample_batched, args.packed_questions)
+        timer.lap('data')
+        if args.resume_rng is not None:
+            # random states of the interrupted run, restored after the loader drew its seeds
+            restore_rng_states(args.resume_rng, args)
+            args.resume_rng = None
+        if batch_idx == start_batch and args.rank == 0:
+            # time since the end of the previous epoch: loaders setup, workers startup and first batch
+            stall = time.perf_counter() - args.epoch_start
+            print('==> epoch {} started after {:.3f} s waiting for the first batch'.format(epoch, stall))
+            if args.metrics is not None:
+                args.metrics.log('epoch_start', epoch=epoch, stall_time=stall, batch_size=len(label))
+
+        # forward and backward pass. With gradient accumulation, the batch is split in micro-batches
+        # whose gradients add up to the ones of the whole batch
         optimizer.zero_grad()
-        output = model(img, qst)
-        loss = F.nll_loss(output, label)
-        loss.backward()
+        micro_batches = split_micro_batches((img, qst, label, object_counts, qst_lengths), args.micro_batches)
+        loss = 0.0
+        for micro_idx, (micro_img, micro_qst, micro_label, micro_counts, micro_lengths) in enumerate(micro_batches):
+            # in distributed training gradients are all-reduced only after the last micro-batch
+            last = micro_idx == len(micro_batches) - 1
+            with model.no_sync() if args.distributed and not last else contextlib.nullcontext():
+                output = model(micro_img, micro_qst, micro_counts, micro_lengths)
+                micro_loss = F.nll_loss(output, micro_label) * (len(micro_label) / len(label))
+                timer.lap('forward')
+                micro_loss.backward()
+                timer.lap('backward')
+            loss += micro_loss.detach()
 
         # Gradient Clipping
         if args.clip_norm:
@@ -49,21 +91,45 @@ def train(data, model, optimizer, scheduler, epoch, args):
         
         if((args.lr_max > 0 and scheduler.get_lr()[0]<args.lr_max) or args.lr_max < 0):
             scheduler.step()
+        timer.lap('optimizer')
             
         # Show progress
         progress_bar.set_postfix(dict(loss=loss.data))
         avg_loss += loss.data
         n_batches += 1
-
-        if batch_idx % args.log_interval == 0:
+        interval_samples += len(label)
+        args.train_iteration += 1
+        if args.profiler is not None:
+            args.profiler.step(args.train_iteration)
+
+        if args.checkpoint_writer is not None and checkpoint_due(args):
+            # epoch is not completed yet: training resumes from the next batch of this epoch
+            save_checkpoint(os.path.join(args.model_dirs, 'RN_latest.pth'), model, optimizer, scheduler,
+                            epoch - 1, batch_idx + 1, train_batch_sampler(data).batch_size * args.world_size, args)
+        # profiler steps and the copy of the training state are not charged to the next batch
+        timer.lap('checkpoint')
+
+        if batch_idx % args.log_interval == 0 and args.rank == 0:
             avg_loss /= n_batches
-            processed = batch_idx * args.batch_size
-            n_samples = len(data) * args.batch_size
+            # samples of all the processes, from the batch size of every process in this epoch
+            batch_size = train_batch_sampler(data).batch_size * args.world_size
+            processed = batch_idx * batch_size
+            n_samples = len(data) * batch_size
             progress = float(processed) / n_samples
             print('Train Epoch: {} [{}/{} ({:.0%})] Train loss: {}'.format(
                 epoch, processed, n_samples, progress, avg_loss))
+            if args.metrics is not None:
+                times = timer.reset()
+                args.metrics.log('train', epoch=epoch, step=batch_idx, iteration=args.train_iteration,
+                                 loss=float(avg_loss), lr=optimizer.param_groups[0]['lr'], batch_size=len(label),
+                                 micro_batches=len(micro_batches),
+                                 samples_per_sec=interval_samples / sum(times.values()),
+                                 **{'{}_time'.format(k): v for k, v in times.items()})
             avg_loss = 0.0
             n_batches = 0
+            interval_samples = 0
+        # printing and writing the record above end up in the next interval
+        timer.lap('logging')
 
 
 def test(data, model, epoch, dictionaries, args):
@@ -81,60 +147,103 @@ def test(data, model, epoch, dictionaries, args):
         class_invalids[c] = 0
         class_n_samples[c] = 0
 
-    corrects = 0.0
-    invalids = 0.0
-    n_samples = 0
-
     inverted_answ_dict = {v: k for k,v in dictionaries[1].items()}
     sorted_classes = sorted(dictionaries[2].items(), key=lambda x: hash(x[1]) if x[1]!='number' else int(inverted_answ_dict[x[0]]))
     sorted_classes = [c[0]-1 for c in sorted_classes]
 
-    confusion_matrix_target = []
-    confusion_matrix_pred = []
-
     sorted_labels = sorted(dictionaries[1].items(), key=lambda x: x[1])
     sorted_labels = [c[0] for c in sorted_labels]
     sorted_labels = [sorted_labels[c] for c in sorted_classes]
 
+    # lookup tables from the (0-based) answer index to its class and to its position in the confusion matrix
+    class_names = list(class_n_samples.keys())
+    n_answers = len(sorted_classes)
+    answer_class = torch.LongTensor([class_names.index(dictionaries[2][a+1]) for a in range(n_answers)])
+    answer_position = torch.LongTensor(n_answers)
+    answer_position[torch.LongTensor(sorted_classes)] = torch.arange(n_answers)
+
+    #handles 'module' for multi-gpu models, pytorch bug #3805
+    net = model.module if hasattr(model, 'module') else model
+    device = next(net.parameters()).device
+    answer_class, answer_position = answer_class.to(device), answer_position.to(device)
+
+    # counts are accumulated on the device of the model, and read only when printed
+    class_corrects_counts = torch.zeros(len(class_names), dtype=torch.long, device=device)
+    class_invalids_counts = torch.zeros(len(class_names), dtype=torch.long, device=device)
+    class_n_samples_counts = torch.zeros(len(class_names), dtype=torch.long, device=device)
+    # confusion_counts[t, p]: answers at position t of the confusion matrix predicted as the one at position p
+    confusion_counts = torch.zeros(n_answers * n_answers, dtype=torch.long, device=device)
+
     avg_loss = 0.0
+    interval_samples = 0
+    timer = utils.StageTimer(sync=args.cuda and args.metrics is not None)
     progress_bar = tqdm(data)
     for batch_idx, sample_batched in enumerate(progress_bar):
-        img, qst, label = utils.load_tensor_data(sample_batched, args.cuda, args.invert_questions, volatile=True)
-        
-        output = model(img, qst)
-        pred = output.data.max(1)[1]
+        # volatile variables are ignored by recent pytorch versions: gradients are disabled explicitly
+        with torch.no_grad():
+            grouped = 'image_index' in sample_batched
+            qst_lengths = utils.load_question_lengths(sample_batched, args.packed_questions)
+            if grouped:
+                img, qst, label, img_index = utils.load_grouped_tensor_data(sample_batched, args.cuda, args.invert_questions, volatile=True, packed_questions=args.packed_questions)
+            else:
+                img, qst, label = utils.load_tensor_data(sample_batched, args.cuda, args.invert_questions, volatile=True, packed_questions=args.packed_questions)
+            # in grouped batches, one count per image
+            object_counts = utils.load_object_counts(sample_batched, args.cuda)
+            timer.lap('data')
+
+            if grouped:
+                # image-grouped batch: the question-independent part runs once per image
+                output = net.answer(net.image_state(img), qst, img_index, qst_lengths, object_counts)
+            else:
+                output = model(img, qst, object_counts, qst_lengths)
+            pred = output.data.max(1)[1]
 
-        loss = F.nll_loss(output, label)
+            loss = F.nll_loss(output, label)
+            timer.lap('forward')
 
         # compute per-class accuracy
-        pred_class = [dictionaries[2][o+1] for o in pred]
-        real_class = [dictionaries[2][o+1] for o in label.data]
-        for idx,rc in enumerate(real_class):
-            class_corrects[rc] += (pred[idx] == label.data[idx])
-            class_n_samples[rc] += 1
-
-        for pc, rc in zip(pred_class,real_class):
-            class_invalids[rc] += (pc != rc)
-
-        for p,l in zip(pred, label.data):
-            confusion_matrix_target.append(sorted_classes.index(l))
-            confusion_matrix_pred.append(sorted_classes.index(p))
-        
-        # compute global accuracy
-        corrects += (pred == label.data).sum()
-        assert corrects == sum(class_corrects.values()), 'Number of correct answers assertion error!'
-        invalids = sum(class_invalids.values())
-        n_samples += len(label)
-        assert n_samples == sum(class_n_samples.values()), 'Number of total answers assertion error!'
-        
-        avg_loss += loss.data[0]
+        label = label.data
+        pred_class = answer_class[pred]
+        real_class = answer_class[label]
+        class_corrects_counts += torch.bincount(real_class[pred == label], minlength=len(class_names))
+        class_invalids_counts += torch.bincount(real_class[pred_class != real_class], minlength=len(class_names))
+        class_n_samples_counts += torch.bincount(real_class, minlength=len(class_names))
+
+        target_position = answer_position[label]
+        pred_position = answer_position[pred]
+        confusion_counts += torch.bincount(target_position * n_answers + pred_position, minlength=n_answers * n_answers)
+
+        avg_loss += loss.item()
+        interval_samples += len(label)
+        timer.lap('metrics')
 
         if batch_idx % args.log_interval == 0:
-            accuracy = corrects / n_samples
-            invalids_perc = invalids / n_samples
+            n_samples = class_n_samples_counts.sum().item()
+            accuracy = class_corrects_counts.sum().item() / n_samples
+            invalids_perc = class_invalids_counts.sum().item() / n_samples
             progress_bar.set_postfix(dict(acc='{:.2%}'.format(accuracy), inv='{:.2%}'.format(invalids_perc)))
+            if args.metrics is not None:
+                times = timer.reset()
+                args.metrics.log('test', epoch=epoch, step=batch_idx, batch_size=len(label),
+                                 samples_per_sec=interval_samples / sum(times.values()),
+                                 **{'{}_time'.format(k): v for k, v in times.items()})
+                interval_samples = 0
     
     avg_loss /= len(data)
+    if net.text.cache is not None:
+        print('==> question embedding cache: {hit_rate:.2%} hits ({hits}/{lookups}), {size} cached questions'.format(
+            lookups=net.text.cache.hits + net.text.cache.misses, **net.text.cache.stats()))
+
+    for c, corrects_, invalids_, n_samples_ in zip(class_names, class_corrects_counts.tolist(),
+                                                    class_invalids_counts.tolist(), class_n_samples_counts.tolist()):
+        class_corrects[c] = corrects_
+        class_invalids[c] = invalids_
+        class_n_samples[c] = n_samples_
+    corrects = float(sum(class_corrects.values()))
+    invalids = sum(class_invalids.values())
+    n_samples = sum(class_n_samples.values())
+    confusion_counts = confusion_counts.view(n_answers, n_answers).cpu().numpy()
+
     invalids_perc = invalids / n_samples      
     accuracy = corrects / n_samples
 
@@ -153,45 +262,249 @@ def test(data, model, epoch, dictionaries, args):
         'class_corrects':class_corrects,
         'class_invalids':class_invalids,
         'class_total_samples':class_n_samples,
-        'confusion_matrix_target':confusion_matrix_target,
-        'confusion_matrix_pred':confusion_matrix_pred,
         'confusion_matrix_labels':sorted_labels,
         'global_accuracy':accuracy
     }
     pickle.dump(dump_object, open(filename,'wb'))
+    if args.metrics is not None:
+        args.metrics.log('test_epoch', epoch=epoch, loss=avg_loss, accuracy=corrects / n_samples, invalids=invalids_perc,
+                         class_accuracy={c: class_corrects[c] / class_n_samples[c] if class_n_samples[c] else 0.0 for c in class_names},
+                         class_invalids={c: class_invalids[c] / class_n_samples[c] if class_n_samples[c] else 0.0 for c in class_names})
+    # the confusion matrix of every epoch is stored as answers x answers counts
+    utils.save_confusion_counts(utils.confusion_counts_filename(args.test_results_dir, epoch), confusion_counts, sorted_labels, epoch)
     return avg_loss
 
-def reload_loaders(clevr_dataset_train, clevr_dataset_test, train_bs, test_bs, state_description = False):
+def reload_loaders(clevr_dataset_train, clevr_dataset_test, train_bs, test_bs, state_description = False, group_by_image = False,
+                   bucket_questions = False, num_workers = 8, distributed = False, seed = 0):
+    # in distributed training every process gets its own shard of the training set (test runs on rank 0 only).
+    # Training batches are shuffled by their own generator, seeded at every epoch with seed + epoch
+    if distributed:
+        sample_sampler = DistributedSampler(clevr_dataset_train, seed=seed)
+    else:
+        sample_sampler = RandomSampler(clevr_dataset_train, generator=torch.Generator())
+    # the batch size of the training batch sampler can be changed with resize_loader,
+    # so that workers stay alive when the batch size is increased
+    if bucket_questions:
+        # training batches are made of questions with similar length, reducing padding
+        train_sampler = LengthBucketBatchSampler(clevr_dataset_train.question_lengths(), train_bs, seed=seed)
+    else:
+        train_sampler = ResizableBatchSampler(sample_sampler, train_bs, drop_last=False, seed=seed)
+    # training workers stay alive between epochs; test workers run once per epoch and are not kept resident
+    persistent_workers = num_workers > 0
+    # loaders draw the base seed of their workers from their own generator instead of the global
+    # random state, which persistent workers would otherwise consume only in the first epoch of a run
+    def loader_generator():
+        return torch.Generator().manual_seed(seed)
+
     if not state_description:
         # Use a weighted sampler for training:
         #weights = clevr_dataset_train.answer_weights()
         #sampler = torch.utils.data.sampler.WeightedRandomSampler(weights, len(weights))
 
         # Initialize Clevr dataset loaders
-        clevr_train_loader = DataLoader(clevr_dataset_train, batch_size=train_bs,
-                                        shuffle=True, num_workers=8, collate_fn=utils.collate_samples_from_pixels)
-        clevr_test_loader = DataLoader(clevr_dataset_test, batch_size=test_bs,
-                                       shuffle=False, num_workers=8, collate_fn=utils.collate_samples_from_pixels)
+        clevr_train_loader = DataLoader(clevr_dataset_train, batch_sampler=train_sampler, num_workers=num_workers,
+                                        collate_fn=utils.collate_samples_from_pixels, persistent_workers=persistent_workers,
+                                        generator=loader_generator())
+        clevr_test_loader = DataLoader(clevr_dataset_test, batch_size=test_bs, shuffle=False, num_workers=num_workers,
+                                       collate_fn=utils.collate_samples_from_pixels,
+                                       generator=loader_generator())
     else:
-        # Initialize Clevr dataset loaders
-        clevr_train_loader = DataLoader(clevr_dataset_train, batch_size=train_bs,
-                                        shuffle=True, collate_fn=utils.collate_samples_state_description)
-        clevr_test_loader = DataLoader(clevr_dataset_test, batch_size=test_bs,
-                                       shuffle=False, collate_fn=utils.collate_samples_state_description)
+        # Initialize Clevr dataset loaders. Scenes are already padded, so that whole mini-batches are
+        # built at once by the datasets instead of collating single samples
+        test_sampler = BatchSampler(SequentialSampler(clevr_dataset_test), test_bs, drop_last=False)
+        clevr_train_loader = DataLoader(BatchedDataset(clevr_dataset_train), batch_size=None, sampler=train_sampler,
+                                        generator=loader_generator())
+        clevr_test_loader = DataLoader(BatchedDataset(clevr_dataset_test), batch_size=None, sampler=test_sampler,
+                                       generator=loader_generator())
+
+    if group_by_image:
+        # every test batch contains all the questions about its images, each image being loaded once
+        test_sampler = ImageGroupedBatchSampler(clevr_dataset_test.image_indexes(), test_bs)
+        collate_fn = utils.collate_samples_grouped_state_description if state_description else utils.collate_samples_grouped_from_pixels
+        clevr_test_loader = DataLoader(ImageGroupedDataset(clevr_dataset_test), batch_size=None, sampler=test_sampler,
+                                       num_workers=0 if state_description else num_workers, collate_fn=collate_fn,
+                                       generator=loader_generator())
     return clevr_train_loader, clevr_test_loader
 
+def split_micro_batches(tensors, n):
+    """
+    Splits the tensors of a batch (None entries are kept as they are) in n micro-batches,
+    returning a list of tuples.
+    """
+    if n == 1:
+        return [tensors]
+    chunks = [t.chunk(n) if t is not None else None for t in tensors]
+    n = min(len(c) for c in chunks if c is not None)
+    return [tuple(c[i] if c is not None else None for c in chunks) for i in range(n)]
+
+def sample_activation_bytes(model, state_description, rl_in_size, cuda, qst_len=45):
+    """
+    Memory of the activations saved for backward by a training step, per sample. It is measured
+    on synthetic batches of 2 and 4 samples, so that the memory not depending on the batch
+    (e.g. the weights) cancels out.
+    """
+    # train-mode forwards update the batch norm statistics: they run on a copy of the model,
+    # and the random states drawn by dropout are left as they were
+    model = copy.deepcopy(model)
+    states = utils.rng_states(cuda)
+    measures = []
+    for batch_size in (2, 4):
+        # non-zero inputs: with packed pairs, all-zero objects would be taken as padding
+        object_counts = None
+        if state_description:
+            img = torch.rand(batch_size, MAX_OBJECTS, rl_in_size // 2)
+            # the worst case, every scene with all the objects
+            object_counts = torch.full((batch_size,), MAX_OBJECTS, dtype=torch.long)
+        elif model.precomputed_conv:
+            img = torch.rand(batch_size, 24, 8, 8)
+        else:
+            img = torch.rand(batch_size, 3, 128, 128)
+        qst = torch.ones(batch_size, qst_len, dtype=torch.long)
+        if cuda:
+            img, qst = img.cuda(), qst.cuda()
+            object_counts = object_counts.cuda() if object_counts is not None else None
+        _, saved = utils.activation_bytes(lambda: model(img, qst, object_counts))
+        measures.append(saved)
+    utils.set_rng_states(states)
+    return max(1, (measures[1] - measures[0]) // 2)
+
+def plan_accumulation(batch_size, max_micro_batch, min_steps=1):
+    """
+    Number of micro-batches batch_size is split in: the micro-batch grows up to max_micro_batch,
+    then the number of accumulation steps grows instead.
+    """
+    return max(min_steps, -(-batch_size // max_micro_batch))
+
+def train_batch_sampler(loader):
+    """
+    The batch sampler of a training loader built by reload_loaders.
+    """
+    return loader.batch_sampler if loader.batch_sampler is not None else loader.sampler
+
+def resize_loader(loader, batch_size):
+    """
+    Changes the batch size of a training loader built by reload_loaders from the next epoch on,
+    without restarting its workers.
+    """
+    train_batch_sampler(loader).set_batch_size(batch_size)
+
+def set_sampler_epoch(loader, epoch):
+    """
+    Sets the order of the training batches of the epoch, which depends only on the seed and the epoch,
+    so that an interrupted epoch can be resumed. Image augmentations are seeded in the same way.
+    """
+    batch_sampler = train_batch_sampler(loader)
+    batch_sampler.set_epoch(epoch)
+    if hasattr(loader.dataset, 'set_epoch'):
+        loader.dataset.set_epoch(epoch, batch_sampler.seed)
+
+def process_seed(args):
+    """
+    Seed of the global random state of this process, different for every process of a distributed
+    training and every training iteration it starts from.
+    """
+    return args.seed + args.rank + args.world_size * args.train_iteration
+
+def restore_rng_states(states, args):
+    """
+    Restores the random states saved in a checkpoint by the first process. The other processes
+    of a distributed training are reseeded instead, so that they do not repeat its random draws.
+    """
+    utils.set_rng_states(states)
+    if args.rank != 0:
+        torch.manual_seed(process_seed(args))
+
+def checkpoint_due(args):
+    """
+    Whether a mid-epoch checkpoint has to be written, after --checkpoint-steps iterations
+    or --checkpoint-minutes since the last one.
+    """
+    if args.checkpoint_steps > 0 and args.train_iteration % args.checkpoint_steps == 0:
+        return True
+    return args.checkpoint_minutes > 0 and time.time() - args.last_checkpoint_time >= args.checkpoint_minutes * 60
+
+def save_checkpoint(filename, model, optimizer, scheduler, epoch, batch, batch_size, args):
+    """
+    Writes the full training state in background, after epoch completed epochs
+    and batch batches of the following one.
+    """
+    args.checkpoint_writer.save({
+        'checkpoint_version': utils.CHECKPOINT_VERSION,
+        'epoch': epoch,
+        'batch': batch,
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'batch_size': batch_size,
+        'train_iteration': args.train_iteration,
+        # the order of the batches depends only on the seed and the epoch
+        'rng': utils.rng_states(args.cuda),
+    }, filename)
+    args.last_checkpoint_time = time.time()
+
+def build_conv_features(clevr_dir, conv, args):
+    """
+    Runs the convolutional layers once on all the train and val images, transformed as in test,
+    and stores their outputs in a ClevrFeatureStore, unless features of the same weights already exist.
+    Returns the key of the store.
+    """
+    key = ClevrFeatureStore.weights_key(conv)
+    array_path, index_path = ClevrFeatureStore.paths(clevr_dir, key)
+    if ClevrFeatureStore.exists(clevr_dir, key):
+        print('==> using cached conv features: {}'.format(array_path))
+        return key
+
+    use_image_store = ClevrImageStore.exists(clevr_dir)
+    transform = transforms.Compose(([] if use_image_store else [transforms.Resize((128, 128))]) + [transforms.ToTensor()])
+    datasets = {mode: ClevrDatasetImages(clevr_dir, mode == 'train', transform,
+                                         ClevrImageStore(clevr_dir, mode == 'train') if use_image_store else None)
+                for mode in ['train', 'val']}
+    index = {'train': {'offset': 0, 'count': len(datasets['train'])},
+             'val': {'offset': len(datasets['train']), 'count': len(datasets['val'])}}
+
+    conv.eval()
+    device = next(conv.parameters()).device
+    with torch.no_grad():
+        feature_shape = conv(torch.zeros(1, 3, 128, 128, device=device)).size()[1:]   # (24 x 8 x 8)
+        tmp_path = array_path + '.tmp'
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                          shape=(len(datasets['train']) + len(datasets['val']),) + tuple(feature_shape))
+        for mode, dataset in datasets.items():
+            loader = DataLoader(dataset, batch_size=args.test_batch_size, shuffle=False, num_workers=args.workers)
+            position = index[mode]['offset']
+            for images in tqdm(loader, desc='conv features of {} images'.format(mode)):
+                features = conv(images.to(device)).cpu().numpy()
+                array[position:position + len(features)] = features
+                position += len(features)
+    array.flush()
+    del array
+    os.replace(tmp_path, array_path)
+
+    with open(index_path, 'w') as index_file:
+        json.dump(index, index_file)
+    print('==> conv features written to {}'.format(array_path))
+    return key
+
 def initialize_dataset(clevr_dir, dictionaries, state_description=True):
     if not state_description:
-        train_transforms = transforms.Compose([transforms.Resize((128, 128)),
+        # images preprocessed by 'preprocess.py images' are already resized
+        use_image_store = ClevrImageStore.exists(clevr_dir)
+        resize = [] if use_image_store else [transforms.Resize((128, 128))]
+        train_transforms = transforms.Compose(resize + [
                                            transforms.Pad(8),
                                            transforms.RandomCrop((128, 128)),
                                            transforms.RandomRotation(2.8),  # .05 rad
                                            transforms.ToTensor()])
-        test_transforms = transforms.Compose([transforms.Resize((128, 128)),
+        test_transforms = transforms.Compose(resize + [
                                           transforms.ToTensor()])
+
+        train_store, test_store = None, None
+        if use_image_store:
+            print('==> using preprocessed images: {}'.format(ClevrImageStore.paths(clevr_dir)[0]))
+            train_store, test_store = ClevrImageStore(clevr_dir, True), ClevrImageStore(clevr_dir, False)
                                           
-        clevr_dataset_train = ClevrDataset(clevr_dir, True, dictionaries, train_transforms)
-        clevr_dataset_test = ClevrDataset(clevr_dir, False, dictionaries, test_transforms)
+        clevr_dataset_train = ClevrDataset(clevr_dir, True, dictionaries, train_transforms, train_store)
+        clevr_dataset_test = ClevrDataset(clevr_dir, False, dictionaries, test_transforms, test_store)
         
     else:
         clevr_dataset_train = ClevrDatasetStateDescription(clevr_dir, True, dictionaries)
@@ -211,6 +524,10 @@ def main(args):
         hyp['dropout'] = args.dropout
     if args.question_injection >= 0:
         hyp['question_injection_position'] = args.question_injection
+    if args.g_tile_size > 0:
+        hyp['g_tile_size'] = args.g_tile_size
+    if args.packed_pairs:
+        hyp['packed_pairs'] = True
 
     print('Loaded hyperparameters from configuration {}, model: {}: {}'.format(args.config, args.model, hyp))
 
@@ -222,7 +539,7 @@ def main(args):
                         args.invert_questions, args.clip_norm, hyp['g_layers'], hyp['question_injection_position'],
                         hyp['f_fc1'], hyp['f_fc2'])
     if not os.path.exists(args.model_dirs):
-        os.makedirs(args.model_dirs)
+        os.makedirs(args.model_dirs, exist_ok=True)
     #create a file in this folder containing the overall configuration
     args_str = str(args)
     hyp_str = str(hyp)
@@ -234,13 +551,35 @@ def main(args):
     args.features_dirs = './features'
     args.test_results_dir = './test_results'
     if not os.path.exists(args.test_results_dir):
-        os.makedirs(args.test_results_dir)
+        os.makedirs(args.test_results_dir, exist_ok=True)
 
     args.cuda = not args.no_cuda and torch.cuda.is_available()
-
-    torch.manual_seed(args.seed)
+    if args.distributed:
+        # gradients are all-reduced with gloo among processes on CPU, sharing the cores
+        args.cuda = False
+        # the other processes wait in barriers while the first one tests or builds the feature cache
+        dist.init_process_group('gloo', rank=args.rank, world_size=args.world_size,
+                                timeout=datetime.timedelta(minutes=args.dist_timeout))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.world_size))
+        print('==> process {} of {} started, using {} threads'.format(args.rank, args.world_size, torch.get_num_threads()))
+
+    args.metrics = utils.MetricsLogger(args.metrics_file) if args.metrics_file and args.rank == 0 else None
+    args.train_iteration = 0
+    args.profiler = None
+    if args.profile_steps and args.rank == 0:
+        args.profiler = utils.StepProfiler(args.profile_steps, './profiles', 'train', args.cuda)
+    # with --profile-data, data is loaded in the main process, where the profiler can see it
+    # the processes of a distributed training share the 8 loader workers
+    args.workers = 0 if args.profile_data else max(1, 8 // args.world_size)
+
+    # every process draws its own dropout masks; shuffling and augmentations are seeded by args.seed alone
+    torch.manual_seed(process_seed(args))
     if args.cuda:
-        torch.cuda.manual_seed(args.seed)
+        torch.cuda.manual_seed(process_seed(args))
+
+    # cached dictionaries and dataset files are built by the first process, the others wait and load them
+    if args.distributed and args.rank != 0:
+        dist.barrier()
 
     print('Building word dictionaries from all the words in the dataset...')
     dictionaries = utils.build_dictionaries(args.clevr_dir)
@@ -250,35 +589,58 @@ def main(args):
     clevr_dataset_train, clevr_dataset_test  = initialize_dataset(args.clevr_dir, dictionaries, hyp['state_description'])
     print('CLEVR dataset initialized!')
 
+    if args.distributed and args.rank == 0:
+        dist.barrier()
+
     # Build the model
     args.qdict_size = len(dictionaries[0])
     args.adict_size = len(dictionaries[1])
 
     model = RN(args, hyp)
 
-    if torch.cuda.device_count() > 1 and args.cuda:
+    if args.question_cache > 0:
+        if torch.cuda.device_count() > 1 and args.cuda:
+            # DataParallel replicas get new copies of the weights at every forward
+            print('==> question embedding cache is not used with multiple GPUs')
+        else:
+            model.text.enable_cache(args.question_cache)
+
+    if args.distributed:
+        if hyp['state_description'] or args.cache_conv_features:
+            # the conv layers are not used on state descriptions, and would never get gradients to reduce
+            model.conv.requires_grad_(False)
+        model = DistributedDataParallel(model)
+    elif torch.cuda.device_count() > 1 and args.cuda:
         model = torch.nn.DataParallel(model)
         model.module.cuda()  # call cuda() overridden method
 
     if args.cuda:
         model.cuda()
+    # the model without DataParallel/DistributedDataParallel wrappers
+    net = model.module if hasattr(model, 'module') else model
 
     start_epoch = 1
+    # full-state checkpoint to resume training from, if any, and where to resume in its epoch
+    resume_state = None
+    args.resume_batch = 0
+    args.resume_rng = None
     if args.resume:
         filename = args.resume
         if os.path.isfile(filename):
             print('==> loading checkpoint {}'.format(filename))
-            checkpoint = torch.load(filename)
+            # full-state checkpoints also contain numpy random states, which are not plain weights
+            checkpoint = torch.load(filename, map_location=lambda storage, loc: storage, weights_only=False)
 
-            #removes 'module' from dict entries, pytorch bug #3805
-            if torch.cuda.device_count() == 1 and any(k.startswith('module.') for k in checkpoint.keys()):
-                checkpoint = {k.replace('module.',''): v for k,v in checkpoint.items()}
-            if torch.cuda.device_count() > 1 and not any(k.startswith('module.') for k in checkpoint.keys()):
-                checkpoint = {'module.'+k: v for k,v in checkpoint.items()}
-
-            model.load_state_dict(checkpoint)
+            #adds or removes 'module' from dict entries, pytorch bug #3805
+            model.load_state_dict(utils.adapt_state_dict(utils.checkpoint_model_state(checkpoint), model))
             print('==> loaded checkpoint {}'.format(filename))
-            start_epoch = int(re.match(r'.*epoch_(\d+).pth', args.resume).groups()[0]) + 1
+            if 'checkpoint_version' in checkpoint:
+                resume_state = checkpoint
+                start_epoch = checkpoint['epoch'] + 1
+                args.resume_batch = checkpoint.get('batch', 0)
+            else:
+                # only the weights were saved by older versions: the epoch is in the filename
+                start_epoch = int(re.match(r'.*epoch_(\d+).pth', args.resume).groups()[0]) + 1
 
     
     if args.conv_transfer_learn:
@@ -287,12 +649,10 @@ def main(args):
 
             print('==> loading conv layer from {}'.format(args.conv_transfer_learn))
             # pretrained dict is the dictionary containing the already trained conv layer
-            pretrained_dict = torch.load(args.conv_transfer_learn)
+            pretrained_dict = utils.adapt_state_dict(utils.checkpoint_model_state(
+                torch.load(args.conv_transfer_learn, map_location=lambda storage, loc: storage, weights_only=False)), net)
 
-            if torch.cuda.device_count() == 1:
-                conv_dict = model.conv.state_dict()
-            else:
-                conv_dict = model.module.conv.state_dict()
+            conv_dict = net.conv.state_dict()
             
             # filter only the conv layer from the loaded dictionary
             conv_pretrained_dict = {k.replace('conv.','',1): v for k, v in pretrained_dict.items() if 'conv.' in k}
@@ -301,12 +661,8 @@ def main(args):
             conv_dict.update(conv_pretrained_dict)
 
             # load the new state dict
-            if torch.cuda.device_count() == 1:
-                model.conv.load_state_dict(conv_dict)
-                params = model.conv.parameters()
-            else:
-                model.module.conv.load_state_dict(conv_dict)
-                params = model.module.conv.parameters()
+            net.conv.load_state_dict(conv_dict)
+            params = net.conv.parameters()
 
             # freeze the weights for the convolutional layer by disabling gradient evaluation
             # for param in params:
@@ -316,12 +672,27 @@ def main(args):
         else:
             print('Cannot load file {}'.format(args.conv_transfer_learn))
 
-    progress_bar = trange(start_epoch, args.epochs + 1)
+    if args.cache_conv_features:
+        assert not hyp['state_description'], '--cache-conv-features needs a from-pixels model'
+        # the conv layers are frozen: their outputs are computed once (by the first process) and read instead of images
+        net.conv.requires_grad_(False)
+        if args.distributed and args.rank != 0:
+            dist.barrier()
+        key = build_conv_features(args.clevr_dir, net.conv, args)
+        if args.distributed and args.rank == 0:
+            dist.barrier()
+        clevr_dataset_train = ClevrDataset(args.clevr_dir, True, dictionaries, feature_store=ClevrFeatureStore(args.clevr_dir, key, True))
+        clevr_dataset_test = ClevrDataset(args.clevr_dir, False, dictionaries, feature_store=ClevrFeatureStore(args.clevr_dir, key, False))
+        net.precomputed_conv = True
+
+    progress_bar = trange(start_epoch, args.epochs + 1, disable=args.rank != 0)
     if args.test:
         # perform a single test
         print('Testing epoch {}'.format(start_epoch))
-        _, clevr_test_loader = reload_loaders(clevr_dataset_train, clevr_dataset_test, args.batch_size, args.test_batch_size, hyp['state_description'])
-        test(clevr_test_loader, model, start_epoch, dictionaries, args)
+        _, clevr_test_loader = reload_loaders(clevr_dataset_train, clevr_dataset_test, args.batch_size, args.test_batch_size, hyp['state_description'], args.group_by_image,
+                                              args.bucket_questions, args.workers)
+        if args.rank == 0:
+            test(clevr_test_loader, net, start_epoch, dictionaries, args)
     else:
         bs = args.batch_size
 
@@ -330,18 +701,72 @@ def main(args):
         candidate_lr = args.lr * args.lr_gamma ** (start_epoch-1 // args.lr_step)
         lr = candidate_lr if candidate_lr <= args.lr_max else args.lr_max
 
-        optimizer = optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=lr, weight_decay=1e-4)
+        params = [p for p in model.parameters() if p.requires_grad]
+        if resume_state is not None:
+            saved_params = sum(len(group['params']) for group in resume_state['optimizer']['param_groups'])
+            if saved_params == len(list(model.parameters())):
+                # saved while the conv layers were trained: frozen ones stay in the optimizer, and never get gradients
+                params = list(model.parameters())
+            elif saved_params != len(params):
+                raise ValueError('{} optimized {} parameters, {} are trainable now: resume with the same --cache-conv-features setting'.format(
+                    args.resume, saved_params, len(params)))
+        optimizer = optim.Adam(params, lr=lr, weight_decay=1e-4)
+        args.micro_batches = args.accumulate_steps
+        # largest micro-batch, from the memory budget or from the batch size probe
+        max_micro_batch = None
+        if args.memory_budget > 0:
+            net.train()
+            sample_bytes = sample_activation_bytes(net, hyp['state_description'], hyp['rl_in_size'], args.cuda)
+            max_micro_batch = max(1, int(args.memory_budget * 2**20 // sample_bytes))
+            print('==> activations take {:.2f} MB per sample, memory budget {} MB'.format(sample_bytes / 2**20, args.memory_budget))
+        elif args.batch_size_probe:
+            max_micro_batch = utils.load_max_batch_size(args.batch_size_probe, args.model, hyp)
+            if max_micro_batch == 0:
+                raise ValueError('No batch of {} fits in the memory budget of {}'.format(args.model, args.batch_size_probe))
+            print('==> largest batch size from {}: {}'.format(args.batch_size_probe, max_micro_batch))
         # scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, 'min', factor=0.5, min_lr=1e-6, verbose=True)
         scheduler = lr_scheduler.StepLR(optimizer, args.lr_step, gamma=args.lr_gamma)
         scheduler.last_epoch = start_epoch
+        if resume_state is not None:
+            # continue exactly where the checkpointed run was
+            optimizer.load_state_dict(resume_state['optimizer'])
+            scheduler.load_state_dict(resume_state['scheduler'])
+            bs = resume_state['batch_size']
+            args.train_iteration = resume_state['train_iteration']
+            if args.resume_batch > 0:
+                # restored at the first batch, after the loader has drawn its seeds as the interrupted run did
+                args.resume_rng = resume_state['rng']
+            else:
+                restore_rng_states(resume_state['rng'], args)
+            print('==> resumed optimizer, scheduler, batch size {} and random states of epoch {}, batch {}'.format(
+                bs, start_epoch, args.resume_batch))
+        # checkpoints are written in background by the first process
+        args.checkpoint_writer = utils.CheckpointWriter(args.keep_checkpoints, r'RN_epoch_\d+\.pth$') if args.rank == 0 else None
+        args.last_checkpoint_time = time.time()
         print('Training ({} epochs) is starting...'.format(args.epochs))
         for epoch in progress_bar:
+            # the stall at the epoch boundary is measured from here to the first training batch
+            args.epoch_start = time.perf_counter()
             
-            if(((args.bs_max > 0 and bs < args.bs_max) or args.bs_max < 0 ) and (epoch % args.bs_step == 0 or epoch == start_epoch)):
-                bs = math.floor(args.batch_size * (args.bs_gamma ** (epoch // args.bs_step)))
-                if bs > args.bs_max and args.bs_max > 0:
-                    bs = args.bs_max
-                clevr_train_loader, clevr_test_loader = reload_loaders(clevr_dataset_train, clevr_dataset_test, bs, args.test_batch_size, hyp['state_description'])
+            schedule_step = ((args.bs_max > 0 and bs < args.bs_max) or args.bs_max < 0) and epoch % args.bs_step == 0
+            if schedule_step or epoch == start_epoch:
+                # a resumed run keeps the batch size it had, until the next step of the schedule
+                if schedule_step or resume_state is None:
+                    bs = math.floor(args.batch_size * (args.bs_gamma ** (epoch // args.bs_step)))
+                    if bs > args.bs_max and args.bs_max > 0:
+                        bs = args.bs_max
+                # in distributed training, bs is split among the processes
+                if epoch == start_epoch:
+                    clevr_train_loader, clevr_test_loader = reload_loaders(clevr_dataset_train, clevr_dataset_test, bs // args.world_size, args.test_batch_size, hyp['state_description'], args.group_by_image,
+                                                                           args.bucket_questions, args.workers, args.distributed, args.seed)
+                else:
+                    # workers are persistent: only the batch sampler changes
+                    resize_loader(clevr_train_loader, bs // args.world_size)
+                if max_micro_batch is not None:
+                    # the batch of every process is split in micro-batches fitting in memory
+                    args.micro_batches = plan_accumulation(bs // args.world_size, max_micro_batch, args.accumulate_steps)
+                    print('==> batch size {}: {} accumulation steps of {} samples'.format(
+                        bs, args.micro_batches, math.ceil(bs // args.world_size / args.micro_batches)))
 
                 #restart optimizer in order to restart learning rate scheduler
                 #for param_group in optimizer.param_groups:
@@ -356,15 +781,39 @@ def main(args):
                 
             # TRAIN
             progress_bar.set_description('TRAIN')
+            set_sampler_epoch(clevr_train_loader, epoch)
             train(clevr_train_loader, model, optimizer, scheduler, epoch, args)
-
-            # TEST
-            progress_bar.set_description('TEST')
-            test(clevr_test_loader, model, epoch, dictionaries, args)
-
-            # SAVE MODEL
-            filename = 'RN_epoch_{:02d}.pth'.format(epoch)
-            torch.save(model.state_dict(), os.path.join(args.model_dirs, filename))
+            if args.profiler is not None and args.profiler.stop > args.train_iteration:
+                # the profiling window does not span epochs, where the test runs
+                args.profiler.finish()
+
+            # in distributed training, test and checkpoints are done only by the first process
+            if args.rank == 0:
+                # TEST
+                progress_bar.set_description('TEST')
+                test(clevr_test_loader, model if not args.distributed else net, epoch, dictionaries, args)
+
+                # SAVE MODEL
+                filename = 'RN_epoch_{:02d}.pth'.format(epoch)
+                save_checkpoint(os.path.join(args.model_dirs, filename), model, optimizer, scheduler, epoch, 0, bs, args)
+                if args.checkpoint_steps > 0 or args.checkpoint_minutes > 0:
+                    # the latest checkpoint is always the one to resume from
+                    save_checkpoint(os.path.join(args.model_dirs, 'RN_latest.pth'), model, optimizer, scheduler, epoch, 0, bs, args)
+            if args.distributed:
+                dist.barrier()
+
+        if args.checkpoint_writer is not None:
+            args.checkpoint_writer.close()
+
+    if args.distributed:
+        dist.destroy_process_group()
+
+def run_distributed(rank, args):
+    """
+    Entry point of the processes spawned by --nprocs.
+    """
+    args.rank = rank
+    main(args)
 
 
 if __name__ == '__main__':
@@ -416,6 +865,63 @@ if __name__ == '__main__':
                         help='configuration file for hyperparameters loading')
     parser.add_argument('--question-injection', type=int, default=-1, 
                         help='At which stage of g function the question should be inserted (0 to insert at the beginning, as specified in DeepMind model, -1 to use configuration value)')
+    parser.add_argument('--g-tile-size', type=int, default=0,
+                        help='evaluate g on the pairs of this many objects at a time, recomputing them during backward: '
+                             'bounds g memory in training and test (0 to use configuration value)')
+    parser.add_argument('--packed-pairs', action='store_true', default=False,
+                        help='for state descriptions, evaluate g only on pairs of real objects, ignoring the padding')
+    parser.add_argument('--packed-questions', action='store_true', default=False,
+                        help='feed the LSTM with packed sequences, so that the question embedding does not depend on padding')
+    parser.add_argument('--bucket-questions', action='store_true', default=False,
+                        help='build training batches of questions with similar length, reducing padding')
+    parser.add_argument('--metrics-file', type=str,
+                        help='append per-interval metrics (loss, lr, throughput, data/forward/backward/optimizer time, peak RSS) to this JSON-lines file')
+    parser.add_argument('--profile-steps', type=utils.parse_profile_steps,
+                        help='profile training iterations from N to M (excluded) given as N:M, writing a trace and a summary into ./profiles')
+    parser.add_argument('--profile-data', action='store_true', default=False,
+                        help='load data in the main process (no DataLoader workers), so that data loading is profiled too')
+    parser.add_argument('--question-cache', type=int, default=0,
+                        help='during test, cache the embeddings of up to this many distinct questions (0 to disable)')
+    parser.add_argument('--group-by-image', action='store_true', default=False,
+                        help='during test, batch together the questions about the same image and process every image only once')
+    parser.add_argument('--keep-checkpoints', type=int, default=0,
+                        help='number of most recent epoch checkpoints to keep, older ones are deleted (default: 0, keep all)')
+    parser.add_argument('--checkpoint-steps', type=int, default=0,
+                        help='also write the training state to RN_latest.pth every N training iterations, to resume in the middle of an epoch (default: 0, disabled)')
+    parser.add_argument('--checkpoint-minutes', type=float, default=0,
+                        help='also write the training state to RN_latest.pth every N minutes of training (default: 0, disabled)')
+    parser.add_argument('--accumulate-steps', type=int, default=1,
+                        help='split every batch in this many micro-batches, accumulating their gradients before the optimizer step (default: 1)')
+    parser.add_argument('--memory-budget', type=float, default=0,
+                        help='MB available for the activations of a micro-batch: when the batch size grows, the number of accumulation steps '
+                             'is increased (from --accumulate-steps) as needed to fit it (default: 0, disabled)')
+    parser.add_argument('--batch-size-probe', type=str,
+                        help='results of "benchmark.py batch-size": micro-batches are kept within the largest batch size found for --model, '
+                             'increasing the accumulation steps as the batch size grows')
+    parser.add_argument('--cache-conv-features', action='store_true', default=False,
+                        help='freeze the conv layers (from --conv-transfer-learn or --resume), store their outputs for all the images once '
+                             'in a memory-mapped file inside the CLEVR directory and train the rest of the network on them')
+    parser.add_argument('--nprocs', type=int, default=1,
+                        help='number of training processes to spawn on this host for distributed CPU training (gloo backend)')
+    parser.add_argument('--dist-timeout', type=int, default=180,
+                        help='minutes distributed processes wait for each other, e.g. while the first one runs the test (default: 180)')
     args = parser.parse_args()
     args.invert_questions = not args.no_invert_questions
-    main(args)
+
+    # distributed training: processes launched by torchrun (or a similar launcher) or spawned here
+    args.world_size = int(os.environ.get('WORLD_SIZE', args.nprocs))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.distributed = args.world_size > 1
+    if args.memory_budget > 0 and args.batch_size_probe:
+        parser.error('--memory-budget and --batch-size-probe cannot be used together')
+    if args.distributed and args.bucket_questions:
+        parser.error('--bucket-questions is not supported in distributed training')
+    if args.cache_conv_features and not (args.conv_transfer_learn or args.resume):
+        # the features of randomly initialized conv layers would be frozen
+        parser.error('--cache-conv-features needs trained conv layers from --conv-transfer-learn or --resume')
+    if args.distributed and 'WORLD_SIZE' not in os.environ:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        mp.spawn(run_distributed, args=(args,), nprocs=args.nprocs)
+    else:
+        main(args)
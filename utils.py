@@ -1,11 +1,22 @@
+import argparse
 import json
 import os
 import pickle
+import queue
+import random
 import re
+import resource
+import sys
+import threading
+import time
 
+import numpy as np
 import torch
 from tqdm import tqdm
 
+# confusion counts files are also read by confusionplot.py, which does not need torch
+from confusion_counts import CONFUSION_COUNTS_VERSION, confusion_counts_filename, save_confusion_counts, load_confusion_counts
+
 classes = {
             'number':['0','1','2','3','4','5','6','7','8','9','10'],
             'material':['rubber','metal'],
@@ -77,6 +88,50 @@ def collate_samples_state_description(batch):
 def collate_samples_images_state_description(batch):
     return collate_samples(batch, True, True)
     
+def collate_samples_grouped_from_pixels(batch):
+    return collate_samples_grouped(batch, False)
+
+def collate_samples_grouped_state_description(batch):
+    return collate_samples_grouped(batch, True)
+
+def collate_samples_grouped(batch, state_description):
+    """
+    Merges samples coming from an ImageGroupedDataset into one mini-batch.
+    Every image is put in the mini-batch only once; 'image_index' tells, for every question,
+    the position of its image inside 'image'.
+    """
+    positions = {}
+    images = []
+    object_counts = []
+    for d in batch:
+        if d['image_index'] not in positions:
+            positions[d['image_index']] = len(images)
+            images.append(d['image'])
+            if 'object_count' in d:
+                object_counts.append(d['object_count'])
+
+    collated_batch = dict(
+        image=collate_samples(images, state_description, True),
+        answer=torch.stack([d['answer'] for d in batch]),
+        question=pad_questions([d['question'] for d in batch]),
+        question_length=torch.LongTensor([len(d['question']) for d in batch]),
+        image_index=torch.LongTensor([positions[d['image_index']] for d in batch])
+    )
+    if object_counts:
+        # number of real objects of every scene in 'image'
+        collated_batch['object_count'] = torch.stack(object_counts)
+    return collated_batch
+
+def pad_questions(questions):
+    # questions are not fixed length: they must be padded to the maximum length
+    # in this batch, in order to be inserted in a tensor
+    max_len = max(map(len, questions))
+
+    padded_questions = torch.LongTensor(len(questions), max_len).zero_()
+    for i, q in enumerate(questions):
+        padded_questions[i, :len(q)] = q
+    return padded_questions
+
 def collate_samples(batch, state_description, only_images):
     """
     Used by DatasetLoader to merge together multiple samples into one mini-batch.
@@ -90,13 +145,8 @@ def collate_samples(batch, state_description, only_images):
         answers = [d['answer'] for d in batch]
         questions = [d['question'] for d in batch]
 
-        # questions are not fixed length: they must be padded to the maximum length
-        # in this batch, in order to be inserted in a tensor
-        max_len = max(map(len, questions))
-
-        padded_questions = torch.LongTensor(batch_size, max_len).zero_()
-        for i, q in enumerate(questions):
-            padded_questions[i, :len(q)] = q
+        padded_questions = pad_questions(questions)
+        question_lengths = torch.LongTensor([len(q) for q in questions])
         
     if state_description:
         max_len = 12
@@ -105,14 +155,17 @@ def collate_samples(batch, state_description, only_images):
         for i, o in enumerate(images):
             padded_objects[i, :o.size()[0], :] = o
         images = padded_objects
+    else:
+        images = torch.stack(images)
     
     if only_images:
-        collated_batch = torch.stack(images)
+        collated_batch = images
     else:
         collated_batch = dict(
-            image=torch.stack(images),
+            image=images,
             answer=torch.stack(answers),
-            question=torch.stack(list(padded_questions))
+            question=torch.stack(list(padded_questions)),
+            question_length=question_lengths
         )
     return collated_batch
 
@@ -130,12 +183,15 @@ def tokenize(sentence):
     return lower
 
 
-def load_tensor_data(data_batch, cuda, invert_questions, volatile=False):
+def load_tensor_data(data_batch, cuda, invert_questions, volatile=False, packed_questions=False):
     # prepare input
     var_kwargs = dict(volatile=True) if volatile else dict(requires_grad=False)
 
     qst = data_batch['question']
-    if invert_questions:
+    if invert_questions and packed_questions:
+        # invert every question within its length, so that padding stays at the end
+        qst = invert_padded_questions(qst, data_batch['question_length'])
+    elif invert_questions:
         # invert question indexes in this batch
         qst_len = qst.size()[1]
         qst = qst.index_select(1, torch.arange(qst_len - 1, -1, -1).long())
@@ -148,3 +204,309 @@ def load_tensor_data(data_batch, cuda, invert_questions, volatile=False):
 
     label = (label - 1).squeeze(1)
     return img, qst, label
+
+
+def invert_padded_questions(qst, lengths):
+    max_len = qst.size()[1]
+    positions = torch.arange(max_len).unsqueeze(0)
+    lengths = lengths.unsqueeze(1)
+    inverted = torch.where(positions < lengths, lengths - 1 - positions, positions)
+    return qst.gather(1, inverted)
+
+
+def load_question_lengths(data_batch, packed_questions):
+    """
+    Lengths of the questions in the batch when questions are to be packed
+    before being processed by the LSTM, None otherwise.
+    """
+    return data_batch['question_length'] if packed_questions else None
+
+
+def load_object_counts(data_batch, cuda):
+    """
+    Number of real (not padding) objects of every scene in the batch, if known.
+    """
+    object_counts = data_batch.get('object_count')
+    if object_counts is not None and cuda:
+        object_counts = object_counts.cuda()
+    return object_counts
+
+
+def load_grouped_tensor_data(data_batch, cuda, invert_questions, volatile=False, packed_questions=False):
+    """
+    Like load_tensor_data, for mini-batches built by collate_samples_grouped.
+    Also returns the index of the image of every question.
+    """
+    img, qst, label = load_tensor_data(data_batch, cuda, invert_questions, volatile, packed_questions)
+    img_index = data_batch['image_index']
+    if cuda:
+        img_index = img_index.cuda()
+    return img, qst, label, img_index
+
+
+# version of the format of the confusion counts files written by save_confusion_counts
+def adapt_state_dict(state_dict, model):
+    """
+    Adds or removes the 'module.' prefix of the keys of state_dict (pytorch bug #3805), depending on whether
+    model is wrapped in DataParallel/DistributedDataParallel, so that checkpoints saved with or without
+    the wrapper can be loaded in both cases.
+    """
+    wrapped = hasattr(model, 'module')
+    prefixed = any(k.startswith('module.') for k in state_dict.keys())
+    if prefixed and not wrapped:
+        return {k.replace('module.', '', 1): v for k, v in state_dict.items()}
+    if wrapped and not prefixed:
+        return {'module.' + k: v for k, v in state_dict.items()}
+    return state_dict
+
+
+# version of the full-state checkpoints written by train.py; plain model state dicts have no version
+CHECKPOINT_VERSION = 1
+
+def checkpoint_model_state(checkpoint):
+    """
+    Returns the model state dict of a checkpoint, either a full-state checkpoint or a plain state dict.
+    """
+    if 'checkpoint_version' in checkpoint:
+        return checkpoint['model']
+    return checkpoint
+
+def rng_states(cuda):
+    """
+    States of all the random number generators used in training, to be restored with set_rng_states.
+    """
+    states = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if cuda:
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['python'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+def cpu_copy(obj):
+    """
+    Copies all the tensors in nested dicts, lists and tuples to new CPU tensors.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints with torch.save in a background thread, so that training does not wait for them.
+    save() copies the state to CPU before returning, so the training loop can keep updating the weights.
+    Every file is written to a temporary file and renamed, so a checkpoint is either complete or absent.
+    With keep > 0, only the keep most recent files matching pattern (a regular expression on the file
+    names inside the directory of the checkpoints) are kept.
+    """
+    def __init__(self, keep=0, pattern=None):
+        self.keep = keep
+        self.pattern = re.compile(pattern) if pattern else None
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, filename):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((cpu_copy(state), filename))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                state, filename = item
+                tmp_filename = filename + '.tmp'
+                torch.save(state, tmp_filename)
+                os.replace(tmp_filename, filename)
+                if self.keep > 0 and self.pattern is not None:
+                    self._remove_old(os.path.dirname(filename))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _remove_old(self, directory):
+        checkpoints = [os.path.join(directory, f) for f in os.listdir(directory) if self.pattern.match(f)]
+        checkpoints.sort(key=os.path.getmtime)
+        for filename in checkpoints[:-self.keep]:
+            os.remove(filename)
+
+    def wait(self):
+        """
+        Blocks until all the pending checkpoints are written.
+        """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+
+def activation_bytes(fn):
+    """
+    Runs fn() and returns (its output, the bytes of all the tensors saved for backward).
+    Tensors sharing the same storage are counted once.
+    """
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(storages.values())
+
+
+# version of the files written by 'benchmark.py batch-size'
+BATCH_SIZE_PROBE_VERSION = 1
+
+def load_max_batch_size(filename, model, hyp=None):
+    """
+    Largest batch size of configuration model found by 'benchmark.py batch-size'.
+    If hyp is given, a warning is printed when the probed hyperparameters were different.
+    """
+    with open(filename) as f:
+        probe = json.load(f)
+    if probe.get('version') != BATCH_SIZE_PROBE_VERSION:
+        raise ValueError('Batch size probe {} has version {}, expected {}'.format(filename, probe.get('version'), BATCH_SIZE_PROBE_VERSION))
+    if model not in probe['models']:
+        raise ValueError('Batch size probe {} has no results for {}'.format(filename, model))
+    result = probe['models'][model]
+    if hyp is not None and result['hyp'] != hyp:
+        print('==> warning: batch size of {} was probed with different hyperparameters: {}'.format(model, result['hyp']))
+    return result['max_batch_size']
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+class StageTimer(object):
+    """
+    Splits the wall time of a loop in stages: lap(stage) charges the time elapsed since the
+    previous lap to stage. With sync, pending CUDA kernels are waited for before reading the clock.
+    """
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.totals = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        if self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def reset(self):
+        """
+        Returns the time spent in every stage since the last reset, and starts counting again.
+        """
+        totals = self.totals
+        self.totals = {}
+        return totals
+
+class MetricsLogger(object):
+    """
+    Appends metrics records to a JSON-lines file, one JSON object per line.
+    Every record also gets the current time and the peak RSS of the process.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'a')
+
+    def log(self, stage, **record):
+        record = dict(stage=stage, time=time.time(), peak_rss_mb=peak_rss_mb(), **record)
+        self.file.write(json.dumps(record) + '\n')
+        # lines are written whole, so that the file can be read while training
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_profile_steps(value):
+    """
+    argparse type for 'N:M' iteration windows: iterations from N (included) to M (excluded).
+    """
+    try:
+        start, stop = (int(v) for v in value.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected N:M, got {}'.format(value))
+    if not 0 <= start < stop:
+        raise argparse.ArgumentTypeError('expected 0 <= N < M, got {}'.format(value))
+    return start, stop
+
+class StepProfiler(object):
+    """
+    Runs the pytorch profiler on the iterations [start, stop) of a loop, recording op-level
+    CPU (and CUDA) time, memory allocations and call stacks.
+    step(iteration) must be called right before the data of that iteration is requested,
+    so that data loading in the main process is profiled too.
+    When the window is over, a chrome trace and a summary of the top ops are written to output_dir.
+    """
+    def __init__(self, steps, output_dir, name, cuda=False, row_limit=30):
+        self.start, self.stop = steps
+        self.output_dir = output_dir
+        self.name = name
+        self.cuda = cuda
+        self.row_limit = row_limit
+        self.profiler = None
+
+    def step(self, iteration):
+        if iteration == self.start and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                                   profile_memory=True, with_stack=True)
+            self.profiler.start()
+            print('==> profiling iterations {} to {}'.format(self.start, self.stop - 1))
+        elif iteration == self.stop and self.profiler is not None:
+            self.finish()
+
+    def finish(self):
+        """
+        Stops the profiler (if running) and writes its results.
+        """
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        basename = os.path.join(self.output_dir, '{}_steps_{}-{}'.format(self.name, self.start, self.stop))
+
+        self.profiler.export_chrome_trace(basename + '_trace.json')
+        time_key = 'self_cuda_time_total' if self.cuda else 'self_cpu_time_total'
+        averages = self.profiler.key_averages()
+        tables = [
+            ('Top ops by self time', averages.table(sort_by=time_key, row_limit=self.row_limit)),
+            ('Top ops by allocated memory', averages.table(sort_by='self_cpu_memory_usage', row_limit=self.row_limit)),
+            ('Top ops by self time, with call stack', self.profiler.key_averages(group_by_stack_n=5).table(
+                sort_by=time_key, row_limit=self.row_limit)),
+        ]
+        with open(basename + '_summary.txt', 'w') as f:
+            for title, table in tables:
+                f.write('{}\n{}\n\n'.format(title, table))
+        print(tables[0][1])
+        print('==> profile written to {}_trace.json and {}_summary.txt'.format(basename, basename))
+        self.profiler = None